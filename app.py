@@ -1,15 +1,71 @@
-from flask import Flask, request, render_template
-from collections import Counter
+from flask import Flask, request, render_template, jsonify
+from functools import lru_cache
 import subprocess
+import json
+import queue
+import time
 import os
 import re
 import csv
 from io import StringIO
+from gprom_pool import (
+    gprom_command,
+    gprom_env,
+    application_name as gprom_application_name,
+    cancel_backend as cancel_gprom_backend,
+)
+from engines import engines
+from streaming import (
+    iter_process_lines,
+    extract_digraph,
+    first_page,
+    FIRST_PAGE_ROWS,
+)
+from result_store import ColumnarResult, results
+from jobs import jobs, JOB_WAIT
+from limits import engine_slot
+import prov_graph
+from circuits import (
+    CIRCUIT_DEPTH,
+    CIRCUIT_TIMEOUT,
+    GATE_QUERY,
+    UUID_RE,
+    circuits,
+    literal_value,
+    uuid_array,
+)
+from probability import SET_PROB_RE, parallel_query, probabilities
+from reenact import REENACT_OPTIONS, sessions as reenact_sessions
+from summaries import (
+    SUMMARY_LIMIT,
+    column_index,
+    count_values,
+    summary_query,
+    summary_rows,
+)
+import metrics
+from metrics import span, count_bytes
+from graph_images import render_image
+from result_cache import (
+    result_cache,
+    cache_key,
+    is_cacheable,
+    is_pinned,
+    referenced_tables,
+    WRITE_MODES,
+)
 
 app = Flask(__name__)
 os.makedirs("static", exist_ok=True)
 
 
+# Engines and their extra modes for the form, see engines.py. Plugins are
+# listed without being loaded.
+@app.context_processor
+def engine_choices():
+    return {"engine_list": engines.choices()}
+
+
 # Normalize SQL queries
 def normalize_sql(sql: str) -> str:
     return " ".join(line.strip() for line in sql.strip().splitlines())
@@ -53,6 +109,12 @@ def parse_psql_ascii_table(output: str):
     return columns, data_rows
 
 
+def is_error_output(output: str) -> bool:
+    return any(
+        x in output.strip().lower() for x in ["error", "fatal", "does not exist"]
+    )
+
+
 def parse_csv_like_output(output: str):
 
     f = StringIO(output)
@@ -65,393 +127,1039 @@ def parse_csv_like_output(output: str):
     return columns, rows
 
 
-@app.route("/", methods=["GET", "POST"])
-def index():
+# Identifies the database behind an engine, part of the result cache key
+def database_identity(engine: str) -> str:
+    return engines.get(engine).identity()
+
+
+def result_cache_key(engine: str, mode: str, full_query: str):
+    if not full_query or full_query.startswith("--"):
+        return None
+    if not is_cacheable(mode, full_query):
+        return None
+    return cache_key(engine, mode, full_query, database_identity(engine))
+
+
+@app.route("/cache/invalidate", methods=["POST"])
+def invalidate_cache():
+    table = request.values.get("table", "").strip()
+    if table:
+        removed = result_cache.invalidate_table(table)
+    elif request.values.get("expired"):
+        removed = result_cache.expire()
+    else:
+        removed = result_cache.clear()
+    return jsonify(removed=removed, **result_cache.stats())
+
+
+# Slice of a stored result: ?offset=&limit=&sort=[-]<col>&filter=<col>:<text>
+@app.route("/results/<result_id>")
+def result_slice(result_id):
+    stored = results.get(result_id)
+    if stored is None:
+        return jsonify(error="Unknown or expired result"), 404
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 200, type=int), 1), 5000)
+    try:
+        sort = None
+        sort_arg = request.args.get("sort", "").strip()
+        if sort_arg:
+            col = int(sort_arg.lstrip("-"))
+            if not 0 <= col < len(stored.columns):
+                raise ValueError(sort_arg)
+            sort = (col, sort_arg.startswith("-"))
+        filters = []
+        for f in request.args.getlist("filter"):
+            col, _, text = f.partition(":")
+            col = int(col)
+            if not 0 <= col < len(stored.columns):
+                raise ValueError(f)
+            if text:
+                filters.append((col, text))
+    except ValueError:
+        return jsonify(error="Invalid sort or filter"), 400
+
+    try:
+        rows, total = stored.slice(offset, limit, sort, filters)
+    except Exception as e:
+        return jsonify(error=str(e)), 500
+    return jsonify(
+        columns=stored.columns,
+        rows=rows,
+        offset=offset,
+        total=total,
+        loaded=stored.length,
+    )
+
+
+# Provenance graph of a stored ProvSQL semiring result, kept for expansion
+@lru_cache(maxsize=8)
+def provenance_graph(result_id: str):
+    stored = results.get(result_id)
+    if stored is None:
+        raise KeyError(result_id)
+    return prov_graph.ProvenanceGraph(
+        *prov_graph.load_provenance(stored.columns, stored.all_rows())
+    )
+
+
+# Bounded view of a provenance graph: ?k=<top outputs>&expand=<node id>...
+# ?format=json exports the formula DAG instead
+@app.route("/graph/<result_id>")
+def graph_view(result_id):
+    try:
+        graph = provenance_graph(result_id)
+    except KeyError:
+        return jsonify(error="Unknown or expired result"), 404
+    except ValueError:
+        return jsonify(error="Result has no sr_formula column"), 400
+    if request.args.get("format") == "json":
+        return jsonify(stats=graph.dag.stats(), **graph.dag.to_dict(graph.roots))
+    top_k = min(max(request.args.get("k", prov_graph.TOP_K, type=int), 1), 5000)
+    expand = request.args.getlist("expand")
+    svg = graph.render(top_k=top_k, expand=expand)
+    return app.response_class(svg, mimetype="image/svg+xml")
+
+
+# Gates of a ProvSQL circuit below <token>, ?depth=<levels>&mapping=<table>
+# labels the input gates. Expanding a child is another call with it as root.
+# Runs as a job, bounded by CIRCUIT_TIMEOUT.
+@app.route("/circuit/<token>")
+def circuit_view(token):
+    depth = min(max(request.args.get("depth", CIRCUIT_DEPTH, type=int), 0), 10)
+    mapping = literal_value(request.args.get("mapping", ""))
+    job = jobs.submit(expand_circuit, token, depth, mapping or None, timeout=CIRCUIT_TIMEOUT)
+    if not job.wait(CIRCUIT_TIMEOUT) or job.status == "timeout":
+        # Ran out of time, or waited that long behind other jobs
+        job.cancel("timeout")
+        return jsonify(error=f"Circuit query timed out after {CIRCUIT_TIMEOUT:g}s"), 504
+    if job.status == "cancelled":
+        return jsonify(error="Circuit query cancelled"), 503
+    if job.error is not None:
+        return jsonify(error=job.error), 502
+    status, body = job.result
+    return jsonify(body), status
+
+
+def expand_circuit(token, depth, mapping, job=None):
+    # (HTTP status, body) of one expansion
+    try:
+        return 200, circuits.expand(token, depth=depth, mapping=mapping, job=job)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    except KeyError:
+        return 404, {"error": "Unknown provenance token"}
+
+
+EXPORT_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+
+# Download a stored result: ?format=csv|parquet|arrow
+@app.route("/results/<result_id>/export")
+def export_result(result_id):
+    stored = results.get(result_id)
+    if stored is None:
+        return jsonify(error="Unknown or expired result"), 404
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_TYPES:
+        return jsonify(error="format must be csv, parquet or arrow"), 400
+    headers = {"Content-Disposition": f"attachment; filename=result.{fmt}"}
+
+    if fmt == "csv":
+        def generate():
+            out = StringIO()
+            writer = csv.writer(out)
+            writer.writerow(stored.columns)
+            for i, row in enumerate(stored.iter_rows()):
+                writer.writerow(row)
+                if i % 1000 == 999:
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+            yield out.getvalue()
+
+        return app.response_class(generate(), mimetype=EXPORT_TYPES[fmt], headers=headers)
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return jsonify(error="Parquet and Arrow exports need pyarrow"), 501
+    table = stored.to_arrow()
+    sink = pa.BufferOutputStream()
+    if fmt == "parquet":
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return app.response_class(
+        sink.getvalue().to_pybytes(), mimetype=EXPORT_TYPES[fmt], headers=headers
+    )
+
+
+# Summary mode: the engine counts occurrences of one column instead of
+# returning the rows. Read-only queries only.
+def wants_summary(fields: dict, full_query: str) -> bool:
+    return bool(
+        fields["summary_column"]
+        and fields["action"] == "Run Query"
+        and full_query
+        and not full_query.startswith("--")
+        and is_cacheable(fields["mode"], full_query)
+    )
+
+
+# Occurrences per value of one column of a stored result:
+# ?column=<name or position>&limit=<n>
+@app.route("/results/<result_id>/summary")
+def result_summary(result_id):
+    stored = results.get(result_id)
+    if stored is None:
+        return jsonify(error="Unknown or expired result"), 404
+    try:
+        index = column_index(stored.columns, request.args.get("column"))
+    except KeyError:
+        return jsonify(error="Unknown column"), 400
+    limit = min(max(request.args.get("limit", SUMMARY_LIMIT, type=int), 1), 10000)
+    column = stored.columns[index]
+
+    # Count from the stored column, reading the rest of the result first
+    labels, counts = count_values(stored.column_values(index), limit)
+    return jsonify(column=column, labels=labels, counts=counts, source="store")
+
+
+# Form fields read as text. JSON bodies (/jobs, /batch) must give them as
+# strings, the checkboxes take any JSON value.
+TEXT_FIELDS = (
+    "query",
+    "mode",
+    "engine",
+    "timestamp",
+    "main_select",
+    "subquery",
+    "baserelation",
+    "has_attrs",
+    "group_by_attrs",
+    "use_attrs",
+    "semirings_table",
+    "semirings_subquery",
+    "view_uuid",
+    "view_table",
+    "action",
+    "wp_subquery",
+    "prob_method",
+    "prob_subquery",
+    "summary_column",
+)
+
+
+def form_error(form):
+    # Message for the first field read_form cannot read, None if all are fine
+    for name in TEXT_FIELDS:
+        value = form.get(name)
+        if value is not None and not isinstance(value, str):
+            return f"{name} must be a string"
+    return None
+
+
+# Form fields of the query page
+def read_form(form) -> dict:
+    return {
+        "query": normalize_sql(form.get("query", "")),
+        "mode": form.get("mode", "default"),
+        "engine": form.get("engine", "gprom"),
+        "timestamp": form.get("timestamp", "").strip(),
+        "main_select": normalize_sql(form.get("main_select", "")),
+        "subquery": normalize_sql(form.get("subquery", "")),
+        "baserelation": form.get("baserelation", "").strip(),
+        "has_attrs": form.get("has_attrs", "").strip(),
+        "group_by_attrs": form.get("group_by_attrs", "").strip(),
+        "use_attrs": form.get("use_attrs", "").strip(),
+        "semirings_table": form.get("semirings_table", "").strip(),
+        "semirings_subquery": normalize_sql(form.get("semirings_subquery", "")),
+        "view_uuid": form.get("view_uuid", "").strip(),
+        "view_table": form.get("view_table", "").strip(),
+        "action": form.get("action", "Run Query"),
+        "wp_subquery": normalize_sql(form.get("wp_subquery", "")),
+        "prob_method": form.get("prob_method", "").strip(),
+        "prob_subquery": normalize_sql(form.get("prob_subquery", "")),
+        "prob_parallel": bool(form.get("prob_parallel")),
+        "show_timings": bool(form.get("show_timings")),
+        "summary_column": form.get("summary_column", "").strip(),
+        "reenact_reuse": bool(form.get("reenact_reuse")),
+    }
+
+
+# Actions of the form, modes come from the engine registry (engines.py)
+FORM_ACTIONS = {"Run Query", "Generate Image", "View Circuit"}
+
+
+# Metric labels of a request. Form values are only used when they name a
+# registered engine, one of its modes or a form action, anything else is
+# "other", so requests cannot add series to /metrics.
+def metric_labels(engine, mode, action=None):
+    modes = set()
+    for choice in engines.choices():
+        if choice["name"] == engine:
+            modes = {value for value, _ in choice["modes"]}
+            break
+    else:
+        engine = "other"
+    labels = (engine, mode if mode in modes else "other")
+    if action is None:
+        return labels
+    return labels + (action if action in FORM_ACTIONS else "other",)
+
+
+EMPTY_RESULT = {
+    "columns": [],
+    "result": [],
+    "raw_output": "",
+    "result_type": "raw",
+    "result_id": None,
+    "result_partial": False,
+    "result_truncated": False,
+    "chart_partial": False,
+    "chart_labels": [],
+    "chart_values": [],
+    "full_query": "",
+    "job_id": None,
+    "graph_svg": None,
+    "graph_image": None,
+    "timings": [],
+    "elapsed_ms": None,
+    "summarized": False,
+    "reenact_note": "",
+    "circuit_root": "",
+    "circuit_mapping": "",
+    "prob_note": "",
+}
+
+
+# Template variables: the form fields plus whatever the query produced
+def page_context(fields: dict, **results) -> dict:
+    context = dict(fields)
+    context.update(EMPTY_RESULT)
+    context.update(results)
+    return context
+
+
+# Builds, runs and parses one query. Runs inside a job (see jobs.py) so it
+# must not touch the Flask request; `job` receives the cancel hooks. Each
+# stage is timed (see metrics.py), the breakdown ends up in `timings`.
+def execute_request(fields: dict, job=None) -> dict:
+    engine, mode, action = fields["engine"], fields["mode"], fields["action"]
+    labels = metric_labels(engine, mode, action)
+    with metrics.trace(*labels) as tr:
+        report(job, f"waiting for a {engine} slot")
+        with engine_slot(engine, job):
+            report(job, "building the query")
+            context, rest = run_request(fields, job)
+            if rest is not None:
+                # The page gets the first rows now, the job goes on reading
+                # the rest into the result store while holding the engine
+                first = dict(context, timings=tr.timings())
+                first["elapsed_ms"] = round((time.perf_counter() - tr.start) * 1000, 2)
+                job.publish(first)
+                context = rest()
+    elapsed = time.perf_counter() - tr.start
+    if job is not None and job.cancel_reason is not None:
+        status = job.cancel_reason
+    elif context["raw_output"].startswith("[ERROR]") or (
+        not context["result"] and is_error_output(context["raw_output"])
+    ):
+        status = "error"
+    else:
+        status = "ok"
+    metrics.request_seconds.observe(elapsed, *labels, status)
+    context["timings"] = tr.timings()
+    context["elapsed_ms"] = round(elapsed * 1000, 2)
+    return context
+
+
+# Stage of a running job, shown by /jobs/<id> and the polling page
+def report(job, text):
+    if job is not None:
+        job.set_progress(text)
+
+
+def run_request(fields: dict, job=None) -> dict:
+    query = fields["query"]
+    mode = fields["mode"]
+    engine = fields["engine"]
+    view_uuid = fields["view_uuid"]
+    view_table = fields["view_table"]
+    action = fields["action"]
+    on_cancel = job.on_cancel if job is not None else None
+
     result = ""
-    query = ""
-    mode = "default"
-    engine = "gprom"
-    timestamp = ""
-    main_select = ""
-    subquery = ""
-    baserelation = ""
-    has_attrs = ""
-    group_by_attrs = ""
-    use_attrs = ""
-    semirings_table = ""
-    semirings_subquery = ""
-    view_uuid = ""
-    view_table = ""
-    wp_subquery = ""
-    prob_method = ""
-    prob_subquery = ""
     full_query = ""
-    action = ""
+    parsed = False
+    failed = False
+    cache_hit = False
+    key = None
+    stream_lines = None
+    stream_rows = None
+    stream_rest = None
+    stored = None
+    result_id = None
+    graph_requested = False
+    graph_svg = None
+    graph_image = None
+    summarized = False
+    reenact_plan = None
+    parallel_prob = False
+    prob_note = ""
 
     columns = []
     result_rows = []
     chart_labels = []
     chart_values = []
 
-    if request.method == "POST":
-        # --- Get all form fields ---
-        query = normalize_sql(request.form.get("query", ""))
-        mode = request.form.get("mode", "default")
-        engine = request.form.get("engine", "gprom")
-        timestamp = request.form.get("timestamp", "").strip()
-        main_select = normalize_sql(request.form.get("main_select", ""))
-        subquery = normalize_sql(request.form.get("subquery", ""))
-        baserelation = request.form.get("baserelation", "").strip()
-        has_attrs = request.form.get("has_attrs", "").strip()
-        group_by_attrs = request.form.get("group_by_attrs", "").strip()
-        use_attrs = request.form.get("use_attrs", "").strip()
-        semirings_table = request.form.get("semirings_table", "").strip()
-        semirings_subquery = normalize_sql(request.form.get("semirings_subquery", ""))
-        view_uuid = request.form.get("view_uuid", "").strip()
-        view_table = request.form.get("view_table", "").strip()
-        action = request.form.get("action", "Run Query")
-        wp_subquery = normalize_sql(request.form.get("wp_subquery", ""))
-        prob_method = request.form.get("prob_method", "").strip()
-        prob_subquery = normalize_sql(request.form.get("prob_subquery", ""))
+    try:
+        # The engine's builder, executor and parser, see engines.py
+        runner = engines.get(engine)
+        if engine == "provsql" and mode == "semirings" and action == "View Circuit":
+            # The circuit is read gate by gate through /circuit/<uuid>
+            # when the page expands it, the semiring query is not run
+            root = literal_value(view_uuid)
+            if not UUID_RE.match(root):
+                context = page_context(
+                    fields,
+                    full_query="-- Missing or invalid UUID for view_circuit",
+                )
+                return context, None
+            context = page_context(
+                fields,
+                full_query=GATE_QUERY.format(ids=uuid_array([root])),
+                result_type="circuit",
+                circuit_root=root.lower(),
+                circuit_mapping=literal_value(view_table),
+            )
+            return context, None
 
-        try:
-            # --- GProM Engine ---
-            if engine == "gprom":
-                if mode == "provenance":
-                    full_query = f"PROVENANCE OF ({query});"
-                elif mode == "timestamp" and timestamp:
-                    full_query = (
-                        f"PROVENANCE AS OF TIMESTAMP '{timestamp}' OF ({query});"
-                    )
-                elif (
-                    mode == "baserelation" and main_select and subquery and baserelation
-                ):
-                    full_query = f"PROVENANCE OF ({main_select} ( {subquery} ) BASERELATION AS {baserelation});"
-                elif mode == "has_provenance" and has_attrs:
-                    upper_query = query.upper()
-                    if "FROM" in upper_query:
-                        from_idx = upper_query.index("FROM") + len("FROM")
-                        before_from = query[:from_idx]
-                        after_from = query[from_idx:].strip()
-                        full_query = f"PROVENANCE OF ({before_from} {after_from} HAS PROVENANCE ({has_attrs})"
-                    else:
-                        full_query = (
-                            f"PROVENANCE OF ({query} HAS PROVENANCE ({has_attrs})"
-                        )
-                    if group_by_attrs:
-                        full_query += f" GROUP BY {group_by_attrs}"
-                    full_query += ");"
-                elif mode == "use_provenance" and use_attrs:
-                    upper_query = query.upper()
-                    if "FROM" in upper_query:
-                        from_idx = upper_query.index("FROM") + len("FROM")
-                        before_from = query[:from_idx]
-                        after_from = query[from_idx:].strip()
-                        full_query = f"PROVENANCE OF ({before_from} {after_from} USE PROVENANCE ({use_attrs})"
-                    else:
-                        full_query = (
-                            f"PROVENANCE OF ({query} USE PROVENANCE ({use_attrs})"
-                        )
-                    if group_by_attrs:
-                        full_query += f" GROUP BY {group_by_attrs}"
-                    full_query += ");"
-                elif mode == "reenact":
-                    full_query = f"REENACT ({query});"
-                elif mode == "reenact_provenance":
-                    full_query = f"REENACT WITH PROVENANCE ({query});"
-                elif mode == "reenact_annotations":
-                    full_query = f"REENACT WITH PROVENANCE ONLY UPDATED SHOW INTERMEDIATE STATEMENT ANNOTATIONS ({query});"
+        # --- Build ---
+        with span("build"):
+            full_query = runner.build(fields)
+            if (
+                engine == "gprom"
+                and fields["reenact_reuse"]
+                and mode in REENACT_OPTIONS
+                and action == "Run Query"
+                and not fields["summary_column"]
+            ):
+                # The same history run before is not re-enacted again
+                reenact_plan = reenact_sessions.plan(
+                    database_identity(engine), mode, query
+                )
+            if (
+                engine == "provsql"
+                and mode == "probability"
+                and fields["prob_parallel"]
+                and action == "Run Query"
+                and not full_query.startswith("--")
+                and not fields["summary_column"]
+                and runner.pool() is not None
+            ):
+                # Distinct tokens are evaluated in batches, see probability.py
+                parallel_prob = True
+                full_query = parallel_query(
+                    fields["prob_subquery"], fields["prob_method"]
+                )
+            if wants_summary(fields, full_query):
+                full_query = summary_query(full_query, fields["summary_column"])
+                summarized = True
+        if engine == "provsql" and mode == "semirings" and action == "Generate Image":
+            if not full_query.startswith("--"):
+                # The graph is drawn in-process from the same rows the
+                # query returns below
+                graph_requested = True
+
+        # --- Execute ---
+        if engine == "gprom" and action == "Generate Image":
+            # Graphviz output needs its own gprom run with extra flags.
+            # Killing gprom leaves its query running in the database, it is
+            # cancelled by name as well.
+            gprom_cmd = gprom_command(
+                "-show_graphviz",
+                "-graphviz_details",
+                "-query",
+                full_query,
+            )
+            app_name = gprom_application_name()
+            process = subprocess.Popen(
+                gprom_cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                env=gprom_env(app_name),
+            )
+            if on_cancel is not None:
+                on_cancel(process.kill)
+                on_cancel(lambda: cancel_gprom_backend(app_name))
+            # Read the digraph straight off the pipe, gprom is stopped
+            # as soon as the graph is complete
+            with span("engine") as s:
+                dot_source, output = extract_digraph(
+                    count_bytes(iter_process_lines(process), s)
+                )
+            if job is not None:
+                job.check()
+            if dot_source is None:
+                result = "[ERROR] GProM produced no graph:\n" + output.strip()
+                failed = True
+            else:
+                graph_image = render_image(dot_source, job=job)
+                result = "Graph generated below:"
+        elif full_query and not full_query.startswith("--"):
+            # "--" marks a mode missing its fields, nothing is run
+            key = result_cache_key(engine, mode, full_query)
+            cached = result_cache.get(key) if key else None
+            if reenact_plan is not None and reenact_plan.hit is not None:
+                saved = reenact_plan.hit
+                columns = saved["columns"]
+                result_rows = saved["rows"]
+                result = saved["text"]
+                parsed = cache_hit = True
+            elif cached is not None:
+                columns, result_rows, result = cached
+                parsed = cache_hit = True
+            elif parallel_prob:
+                columns, result_rows, prob_note = probabilities.evaluate(
+                    runner.pool(),
+                    fields["prob_subquery"],
+                    fields["prob_method"],
+                    job=job,
+                )
+                parsed = True
+            else:
+                with span("engine") as s:
+                    output = runner.run(full_query, job)
+                if isinstance(output, tuple) and len(output) == 3:
+                    # A statement that ran to completion, e.g. on the
+                    # ProvSQL pool
+                    columns, result_rows, result = output
+                    s.rows = len(result_rows)
+                    parsed = True
+                elif isinstance(output, tuple):
+                    # Typed rows, read as the page needs them
+                    columns, rows = output
+                    stream_rows = (list(r) for r in rows)
+                    parsed = True
                 else:
-                    full_query = query.rstrip(";") + ";"
-
-                # --- Execute GProM ---
-                if action == "Run Query":
-                    gprom_cmd = [
-                        "/home/user/gprom/src/command_line/gprom",
-                        "-db",
-                        "gprom_db",
-                        "-backend",
-                        "postgres",
-                        "-host",
-                        "localhost",
-                        "-port",
-                        "5432",
-                        "-user",
-                        "postgres",
-                    ]
-                    process = subprocess.Popen(
-                        gprom_cmd,
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                    )
-                    stdout, stderr = process.communicate(input=full_query + "\n\\q\n")
-                    result = stdout if stdout else stderr
-                elif action == "Generate Image":
-                    gprom_cmd = [
-                        "/home/user/gprom/src/command_line/gprom",
-                        "-db",
-                        "gprom_db",
-                        "-backend",
-                        "postgres",
-                        "-host",
-                        "localhost",
-                        "-port",
-                        "5432",
-                        "-user",
-                        "postgres",
-                        "-show_graphviz",
-                        "-graphviz_details",
-                        "-query",
-                        full_query,
-                    ]
-                    with open("provenance_output.txt", "w") as f:
-                        subprocess.run(
-                            gprom_cmd,
-                            stdout=f,
-                            stderr=subprocess.STDOUT,
-                            text=True,
-                            check=True,
-                        )
-
-                    # Extract graph from output
-                    found = False
-                    depth = 0
-                    with open("provenance_output.txt") as infile, open(
-                        "output.dot", "w"
-                    ) as outfile:
-                        for line in infile:
-                            if not found and "GRAPHVIZ: AFTER OPTIMIZATIONS" in line:
-                                found = True
-                                continue
-                            if found:
-                                if "digraph G {" in line:
-                                    depth = 1
-                                    outfile.write(line)
-                                    continue
-                                if depth > 0:
-                                    outfile.write(line)
-                                    depth += line.count("{") - line.count("}")
-                                    if depth == 0:
-                                        break
-                    subprocess.run(
-                        ["dot", "-Tpng", "output.dot", "-o", "static/output.png"],
-                        check=True,
-                    )
-                    result = "Graph generated below:"
-
-            # --- ProvSQL Engine ---
-            elif engine == "provsql":
-                if mode == "default":
-                    full_query = query.rstrip(";") + ";"
-                elif mode == "add_provenance":
-                    full_query = f"SELECT add_provenance({query});"
-                elif mode == "create_provenance_mapping":
-                    full_query = f"SELECT create_provenance_mapping({query});"
-                elif mode == "semirings":
-                    if semirings_table and semirings_subquery:
-                        full_query = (
-                            f"SELECT *, SR_FORMULA(PROVENANCE(), {semirings_table}) "
-                            f"FROM ({semirings_subquery}) t;"
-                        )
-                        if action == "Generate Image":
-                            # Step 1: Write the SQL to a file
-                            sql_commands = f"""
-                            SET search_path TO provsql_test, provsql;
-                            \\copy ({full_query.rstrip(';')}) TO '/tmp/prov_output.csv' CSV HEADER ENCODING 'UTF8';
-                            """
-                            with open("temp_export.sql", "w", encoding="utf-8") as f:
-                                f.write(sql_commands)
-
-                            # Step 2: Copy the SQL file into the container
-                            subprocess.run(
-                                [
-                                    "docker",
-                                    "cp",
-                                    "temp_export.sql",
-                                    "provsql-demo:/tmp/temp_export.sql",
-                                ],
-                                check=True,
-                            )
-
-                            # Step 3: Execute it inside the container
-                            subprocess.run(
-                                [
-                                    "docker",
-                                    "exec",
-                                    "-i",
-                                    "provsql-demo",
-                                    "psql",
-                                    "-U",
-                                    "test",
-                                    "-d",
-                                    "test",
-                                    "-f",
-                                    "/tmp/temp_export.sql",
-                                ],
-                                check=True,
-                            )
-
-                            # Step 4: Copy the exported CSV back out
-                            subprocess.run(
-                                [
-                                    "docker",
-                                    "cp",
-                                    "provsql-demo:/tmp/prov_output.csv",
-                                    "./static/prov_output.csv",
-                                ],
-                                check=True,
-                            )
-
-                            # Step 5: Clean up
-                            os.remove("temp_export.sql")
-
-                            # Step 6: Generate PNG
-                            subprocess.run(
-                                ["venv/bin/python3", "prov_graph.py"], check=True
-                            )
-
-                            result = (
-                                "Graph generated as prov_graph.png in static folder."
-                            )
-                        elif action == "View Circuit":
-
-                            if not view_uuid and not view_table:
-                                return render_template(
-                                    "index.html",
-                                    full_query="-- Missing UUID or table for view_circuit",
-                                    engine=engine,
-                                    mode=mode,
-                                )
-                           
-                            first_query = full_query
-                            full_query = f"SELECT VIEW_CIRCUIT({view_uuid}, {view_table});"
-                            both_query = first_query + " " + full_query
-
-                            # Execute query inside Docker and capture output as text
-                            docker_cmd = [
-                                "docker",
-                                "exec",
-                                "-i",
-                                "provsql-demo",
-                                "psql",
-                                "-U",
-                                "test",
-                                "-d",
-                                "test",
-                                "-c",
-                                both_query,
-                            ]
-                            result = subprocess.run(docker_cmd, capture_output=True, text=True)
-
-                            # Capture the raw ASCII circuit output
-                            raw_output = result.stdout or result.stderr
-
-                            # Mark result as raw text
-                            return render_template(
-                                "index.html",
-                                full_query=full_query,
-                                result_type="raw",
-                                raw_output=raw_output,
-                                engine=engine,
-                                mode=mode,
-                                view_uuid=view_uuid,
-                                view_table=view_table,
-                                semirings_table=semirings_table,
-                                semirings_subquery=semirings_subquery,
-                                action=action,
-                            )
-                    else:
-                        full_query = "-- Missing table or subquery for semirings"
+                    stream_lines = iter(output)
 
-                elif mode == "where_provenance":
-                    if wp_subquery:
-                        full_query = f"SELECT *, where_provenance(provenance()) FROM ({wp_subquery}) t;"
-                    else:
-                        full_query = "-- Missing subquery for WHERE_PROVENANCE"
-                elif mode == "probability":
-                    if prob_method and prob_subquery:
-                        full_query = (
-                            f"SELECT *, probability_evaluate(provenance(), {prob_method}) "
-                            f"FROM ({prob_subquery}) t;"
-                        )
+        # --- Stream results ---
+        # Output is parsed while it is read. The first page of rows is kept
+        # for the page, the rest goes straight into the result store. The
+        # stream stage covers waiting for the engine and parsing that page.
+        if stream_lines is not None or stream_rows is not None:
+            report(job, f"running on {engine}")
+            with span("stream") as s:
+                if stream_lines is not None:
+                    # The engine's parser, see engines.py
+                    table = runner.parse(count_bytes(stream_lines, s))
+                    result = table.text
+                    if table.found and not is_error_output(result):
+                        columns, stream_rows = table.columns, table.rows()
+                        parsed = True
                     else:
-                        full_query = "-- Missing method or subquery for PROBABILITY"
-
-                # Execute via Docker
-                docker_cmd = [
-                    "docker",
-                    "exec",
-                    "-i",
-                    "provsql-demo",
-                    "psql",
-                    "-U",
-                    "test",
-                    "test",
-                    "-c",
-                    full_query,
-                ]
-                process = subprocess.Popen(
-                    docker_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                )
-                stdout, stderr = process.communicate()
-                result = stdout if stdout else stderr
+                        # No table (or an error): the text is parsed below
+                        table.close()
+                if stream_rows is not None:
+                    result_rows, stream_rest = first_page(stream_rows)
+                    s.rows = len(result_rows)
 
-        except Exception as e:
-            result = f"[ERROR] {str(e)}\n\n---\nQuery attempted:\n{full_query if engine=='provsql' else query}"
+    except Exception as e:
+        parsed = False
+        result = f"[ERROR] {str(e)}\n\n---\nQuery attempted:\n{query if engine=='gprom' else full_query}"
 
-        # --- Parse results robustly ---
-        # --- Parse results robustly ---
-        if any(
-            x in result.strip().lower() for x in ["error", "fatal", "does not exist"]
-        ):
-            columns = []
-            result_rows = []
+    pending = False
+    if stream_rest is not None and not failed:
+        # Rows past the first page go into the result store, which holds at
+        # most `results.max_cells` cells of one result
+        stored = ColumnarResult(
+            columns,
+            result_rows,
+            source=stream_rest,
+            close=stream_rows.close,
+            max_cells=results.max_cells,
+        )
+        stream_rest = None
+        if graph_requested or job is None:
+            # The graph needs every row, and without a job nothing can read
+            # the rest later: read it now
+            error = read_rest(stored, job)
+            if error is not None:
+                stored = None
+                parsed = False
+                result = f"[ERROR] {error}\n\n---\nQuery attempted:\n{query if engine=='gprom' else full_query}"
+        else:
+            # The job reads the rest once the first page is published, see
+            # execute_request
+            pending = True
+
+    if job is not None and job.cancel_reason is not None:
+        # The child or backend query was killed, whatever was read is partial
+        parsed = False
+        if job.cancel_reason == "timeout":
+            result = f"[ERROR] Query timed out after {job.timeout:g}s"
         else:
-            # Parse normally
+            result = "[ERROR] Query cancelled"
+        if stored is not None:
+            stored.close()
+            stored = None
+            pending = False
+
+    # --- Parse results robustly ---
+    if parsed:
+        # Pooled ProvSQL results and cache hits are already typed rows
+        pass
+    elif is_error_output(result):
+        failed = True
+        columns = []
+        result_rows = []
+    else:
+        # Parse normally
+        with span("parse") as s:
             columns, result_rows = parse_psql_ascii_table(result)
             if not columns and not result_rows:
                 columns, result_rows = parse_csv_like_output(result)
+            s.bytes = len(result)
+            s.rows = len(result_rows)
 
-        # Chart data
-        if result_rows:
-            counts = Counter(r[0] for r in result_rows)
-            chart_labels = list(counts.keys())
-            chart_values = list(counts.values())
+    def keep():
+        # Whole results are kept for reuse, once every row is read
+        rows = stored.all_rows if stored is not None else lambda: result_rows
+        if stored is not None and stored.truncated:
+            return
+        # --- REENACT history ---
+        # Same size bound as the result cache below
+        if (
+            reenact_plan is not None
+            and reenact_plan.hit is None
+            and not failed
+            and (job is None or job.cancel_reason is None)
+            and (stored is None or stored.cells() * 2 <= reenact_sessions.store.max_bytes)
+        ):
+            reenact_sessions.save(reenact_plan, columns, rows(), result)
+
+        # --- Result cache ---
+        # Every pickled cell takes at least two bytes, so results with more
+        # cells than that cannot fit and are not pickled.
+        if (
+            key is not None
+            and not cache_hit
+            and not failed
+            and (stored is None or stored.cells() * 2 <= result_cache.max_bytes)
+        ):
+            value = (columns, rows(), result)
+            if mode == "timestamp" and fields["timestamp"] and is_pinned(full_query):
+                # Provenance as of a fixed timestamp never changes
+                result_cache.put(key, value, ttl=None)
+            else:
+                result_cache.put(key, value, tables=referenced_tables(full_query))
 
-    return render_template(
-        "index.html",
+    if not pending:
+        keep()
+    if full_query and not failed and not is_cacheable(mode, full_query):
+        # The statement may have changed data, drop what it touched
+        if mode in WRITE_MODES:
+            result_cache.clear()
+            reenact_sessions.clear()
+        else:
+            for table in referenced_tables(full_query):
+                result_cache.invalidate_table(table)
+                reenact_sessions.invalidate_table(table)
+                circuits.invalidate_table(table)
+        if SET_PROB_RE.search(full_query):
+            # Input probabilities changed, memoized probabilities are stale
+            probabilities.clear()
+
+    # --- Result store ---
+    # Tables are browsed through /results/<id>, the page only gets the
+    # first rows
+    if columns and result_rows:
+        if stored is None:
+            stored = ColumnarResult(columns, result_rows)
+        with span("store"):
+            result_id = results.add(stored, persist=not pending)
+        if not summarized:
+            result_rows = result_rows[:FIRST_PAGE_ROWS]
+    elif stream_rows is not None:
+        stream_rows.close()
+
+    # --- Provenance graph (ProvSQL) ---
+    if graph_requested and result_id is not None:
+        try:
+            graph = provenance_graph(result_id)
+            graph_svg = graph.render().decode("utf-8")
+        except Exception as e:
+            result = f"[ERROR] Could not draw the provenance graph: {e}"
+    elif graph_requested and not failed:
+        result = "[ERROR] The query returned no rows to draw"
+
+    context = page_context(
+        fields,
         columns=columns,
         result=result_rows,
         raw_output=result,
         result_type="table" if columns and result_rows else "raw",
-        chart_labels=chart_labels,
-        chart_values=chart_values,
-        query=query,
-        mode=mode,
-        engine=engine,
-        timestamp=timestamp,
-        main_select=main_select,
-        subquery=subquery,
-        baserelation=baserelation,
-        has_attrs=has_attrs,
-        group_by_attrs=group_by_attrs,
-        use_attrs=use_attrs,
-        semirings_table=semirings_table,
-        semirings_subquery=semirings_subquery,
-        view_uuid=view_uuid,
-        view_table=view_table,
-        wp_subquery=wp_subquery,
-        prob_method=prob_method,
-        prob_subquery=prob_subquery,
+        result_id=result_id,
         full_query=full_query,
-        action=action,
+        graph_svg=graph_svg,
+        graph_image=graph_image,
+        summarized=summarized,
+        reenact_note=reenact_plan.describe() if reenact_plan is not None else "",
+        prob_note=prob_note,
+    )
+    if summarized:
+        # The engine already counted, rows are (value, occurrences)
+        context["chart_labels"], context["chart_values"] = summary_rows(result_rows)
+    elif result_id is not None:
+        describe_stored(context, stored)
+    if not pending:
+        return context, None
+
+    def rest():
+        # Runs in the job after the first page was published: reads the
+        # rest into the store, then keeps and shares the whole result
+        read_rest(stored, job)
+        if job.cancel_reason is None:
+            keep()
+        try:
+            results.persist(result_id, stored)
+        except OSError:
+            pass
+        final = dict(context)
+        describe_stored(final, stored)
+        return final
+
+    return context, rest
+
+
+def read_rest(stored, job=None):
+    # Reads the rest of a streamed result into the store, which frees the
+    # gprom worker or pooled connection. Returns the error, if any; the
+    # result then ends at the rows read so far.
+    try:
+        with span("stream") as s:
+            s.rows = stored.read_all(lambda n: report(job, f"{n} rows read"))
+    except Exception as e:
+        stored.close()
+        return str(e) or type(e).__name__
+    return None
+
+
+def describe_stored(context: dict, stored):
+    # Paging and chart fields of a stored result. While rows are still
+    # being read, the chart counts the first page only.
+    context["result_partial"] = not stored.complete or stored.length > FIRST_PAGE_ROWS
+    context["result_truncated"] = stored.truncated
+    with span("chart"):
+        if stored.complete:
+            # Every value of every stored row
+            values = stored.column_values(0)
+            context["chart_partial"] = False
+        else:
+            values = [r[0] for r in context["result"]]
+            context["chart_partial"] = True
+        context["chart_labels"], context["chart_values"] = count_values(values, None)
+
+
+# The query page, rendering is timed as its own stage
+def render_page(context: dict) -> str:
+    labels = metric_labels(context.get("engine"), context.get("mode"))
+    with span("render", *labels) as s:
+        html = render_template("index.html", **context)
+        s.bytes = len(html)
+    return html
+
+
+metrics.register(
+    metrics.Gauge(
+        "provenance_result_cache_entries",
+        "Results held in the result cache",
+        lambda: result_cache.stats()["entries"],
     )
+)
+metrics.register(
+    metrics.Gauge(
+        "provenance_result_cache_bytes",
+        "Pickled size of the cached results",
+        lambda: result_cache.stats()["bytes"],
+    )
+)
+metrics.register(
+    metrics.CounterFunc(
+        "provenance_result_cache_hits_total",
+        "Result cache hits",
+        lambda: result_cache.stats()["hits"],
+    )
+)
+metrics.register(
+    metrics.CounterFunc(
+        "provenance_result_cache_misses_total",
+        "Result cache misses",
+        lambda: result_cache.stats()["misses"],
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "provenance_stored_results",
+        "Results browsable through /results/<id>",
+        lambda: len(results),
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "provenance_reenact_histories",
+        "Results of re-enacted histories kept for reuse",
+        lambda: reenact_sessions.stats()["entries"],
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "provenance_circuit_gates",
+        "ProvSQL circuit gates held in memory",
+        lambda: circuits.stats()["gates"],
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "provenance_memoized_probabilities",
+        "Probabilities memoized per provenance token",
+        lambda: probabilities.stats()["entries"],
+    )
+)
+
+
+# Other workers read this one's metrics from METRICS_DIR (see server.py)
+metrics.start_flushing()
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return app.response_class(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+@app.route("/", methods=["GET", "POST"])
+def index():
+    if request.method != "POST":
+        return render_page(page_context(read_form({}), action=""))
+
+    fields = read_form(request.form)
+    job = jobs.submit(execute_request, fields)
+    job.fields = fields
+    if not job.wait_result(JOB_WAIT):
+        # Long query: free this worker, the page polls the job instead
+        return render_page(page_context(fields, job_id=job.id))
+    return render_page(job_context(job, fields))
+
+
+# Template variables for a finished job
+def job_context(job, fields: dict) -> dict:
+    if job.result is not None:
+        return job.result
+    if job.status == "timeout":
+        message = f"[ERROR] Query timed out after {job.timeout:g}s"
+    elif job.status == "cancelled":
+        message = "[ERROR] Query cancelled"
+    else:
+        message = f"[ERROR] {job.error}"
+    return page_context(fields, raw_output=message)
+
+
+# --- Asynchronous query jobs ---
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    body = request.get_json(silent=True)
+    form = body if isinstance(body, dict) else request.form
+    error = form_error(form)
+    if error is not None:
+        return jsonify(error=error), 400
+    fields = read_form(form)
+    try:
+        timeout = form.get("timeout", request.args.get("timeout"))
+        timeout = float(timeout) if timeout not in (None, "") else None
+    except (TypeError, ValueError):
+        return jsonify(error="timeout must be a number"), 400
+    job = jobs.submit(execute_request, fields, timeout=timeout)
+    job.fields = fields
+    return jsonify(job.info()), 202
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    info = job.info()
+    if job.result is not None:
+        # Published with the first page, the rest may still be read
+        context = job.result
+        info.update(
+            full_query=context["full_query"],
+            columns=context["columns"],
+            rows=context["result"],
+            result_id=context["result_id"],
+            raw_output=context["raw_output"] if not context["result"] else "",
+        )
+    return jsonify(info)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    job.cancel()
+    return jsonify(job.info())
+
+
+@app.route("/jobs/<job_id>/view")
+def job_view(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return render_template(
+            "index.html", **page_context(read_form({}), raw_output="[ERROR] Unknown job")
+        )
+    fields = getattr(job, "fields", None) or read_form({})
+    if not job.ready:
+        return render_page(page_context(fields, job_id=job.id))
+    return render_page(job_context(job, fields))
+
+
+# --- Batch execution ---
+# Many queries in one request, run as jobs on the shared ProvSQL connections
+# and gprom workers, at most `parallelism` at a time
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", "4"))
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", "500"))
+
+
+# Form fields for one batch spec: {"engine", "mode", "query", "params"}.
+# Raises ValueError when the spec has fields read_form cannot read.
+def batch_fields(spec: dict) -> dict:
+    params = spec.get("params") or {}
+    if not isinstance(params, dict):
+        raise ValueError("params must be an object")
+    form = dict(params)
+    for name in ("engine", "mode", "query"):
+        if name in spec:
+            form[name] = spec[name]
+    form["action"] = "Run Query"
+    error = form_error(form)
+    if error is not None:
+        raise ValueError(error)
+    return read_form(form)
+
+
+def batch_item(fields: dict, index: int, finished, job=None) -> dict:
+    try:
+        return execute_request(fields, job=job)
+    finally:
+        finished.put(index)
+
+
+# One NDJSON line for a finished batch job, with every row of its result
+def batch_line(index: int, job) -> dict:
+    line = {"index": index}
+    line.update(job.info())
+    context = job.result
+    if context is None:
+        return line
+    rows = context["result"]
+    partial = context["result_partial"]
+    if context["result_id"] is not None:
+        # Not browsed from the page, so read it whole and free the store
+        stored = results.remove(context["result_id"])
+        if stored is not None:
+            rows = stored.all_rows()
+            stored.close()
+            partial = stored.truncated
+    line.update(
+        full_query=context["full_query"],
+        columns=context["columns"],
+        rows=rows,
+        partial=partial,
+    )
+    if context["raw_output"].startswith("[ERROR]"):
+        line["status"] = "failed"
+        line["error"] = context["raw_output"]
+    elif not rows:
+        line["raw_output"] = context["raw_output"]
+    return line
+
+
+def run_batch(batch: list, parallelism: int, timeout=None):
+    started = time.time()
+    finished = queue.Queue()
+    pending = iter(enumerate(batch))
+    running = {}
+    try:
+        while True:
+            while len(running) < parallelism:
+                item = next(pending, None)
+                if item is None:
+                    break
+                index, fields = item
+                running[index] = jobs.submit(
+                    batch_item, fields, index, finished, timeout=timeout
+                )
+            if not running:
+                break
+            index = finished.get()
+            job = running.pop(index)
+            job.wait()
+            yield json.dumps(batch_line(index, job), default=str) + "\n"
+        yield json.dumps(
+            {"done": True, "queries": len(batch), "elapsed": round(time.time() - started, 3)}
+        ) + "\n"
+    finally:
+        # Client went away: stop whatever is still running
+        for job in running.values():
+            job.cancel()
+
+
+@app.route("/batch", methods=["POST"])
+def batch_execute():
+    body = request.get_json(silent=True)
+    specs = body.get("queries") if isinstance(body, dict) else body
+    if not isinstance(specs, list) or not specs:
+        return jsonify(error="Expected a non-empty list of queries"), 400
+    if len(specs) > BATCH_MAX_QUERIES:
+        return jsonify(error=f"At most {BATCH_MAX_QUERIES} queries per batch"), 400
+    if not all(isinstance(spec, dict) for spec in specs):
+        return jsonify(error="Each query must be an object"), 400
+    options = body if isinstance(body, dict) else {}
+    try:
+        parallelism = int(options.get("parallelism", BATCH_PARALLELISM))
+        timeout = options.get("timeout")
+        timeout = float(timeout) if timeout is not None else None
+    except (TypeError, ValueError):
+        return jsonify(error="parallelism and timeout must be numbers"), 400
+    parallelism = min(max(parallelism, 1), BATCH_PARALLELISM)
+    batch = []
+    for index, spec in enumerate(specs):
+        try:
+            batch.append(batch_fields(spec))
+        except ValueError as e:
+            return jsonify(error=f"Query {index}: {e}"), 400
+    return app.response_class(
+        run_batch(batch, parallelism, timeout), mimetype="application/x-ndjson"
+    )
+
+
+# Connections and gprom processes of ENGINE_WARMUP are opened meanwhile
+engines.warm_in_background()
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    # Development server, see server.py for production
+    app.run(debug=True)
@@ -0,0 +1,463 @@
+# Benchmark of the provenance query paths. Replays a workload over every
+# engine/mode branch of the query page against stub gprom and psql
+# executables (so it runs offline) and times each phase separately: query
+# building, engine time, parsing, chart aggregation, template rendering,
+# graph generation, and the whole request end to end.
+#
+#   python3 benchmark.py --rows 5000 --repeat 5 --output bench.json
+#   python3 benchmark.py --output new.json --compare bench.json
+#
+# The stubs print synthetic psql-style tables of --rows x --cols cells, or
+# replay recorded output from --recordings DIR (files named
+# <engine>-<kind>.txt, or .csv for psql --csv, see output_kind).
+
+
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Stub output settings, passed to the stub processes through the environment
+ROWS = int(os.environ.get("BENCH_ROWS", "1000"))
+COLS = int(os.environ.get("BENCH_COLS", "4"))
+RECORDINGS = os.environ.get("BENCH_RECORDINGS", "")
+
+CITIES = ["Paris", "Berlin", "Rome", "Madrid", "Lisbon", "Vienna", "Prague"]
+
+
+# (engine, mode, action, extra form fields): one entry per branch of
+# execute_request
+WORKLOAD = [
+    ("gprom", "default", "Run Query", {}),
+    ("gprom", "provenance", "Run Query", {}),
+    ("gprom", "timestamp", "Run Query", {"timestamp": "2024-01-01 00:00:00"}),
+    (
+        "gprom",
+        "baserelation",
+        "Run Query",
+        {
+            "main_select": "SELECT * FROM",
+            "subquery": "SELECT a, b FROM r",
+            "baserelation": "r",
+        },
+    ),
+    ("gprom", "has_provenance", "Run Query", {"has_attrs": "b", "group_by_attrs": "a"}),
+    ("gprom", "use_provenance", "Run Query", {"use_attrs": "b"}),
+    ("gprom", "reenact", "Run Query", {}),
+    ("gprom", "reenact_provenance", "Run Query", {}),
+    ("gprom", "reenact_annotations", "Run Query", {}),
+    ("gprom", "provenance", "Generate Image", {}),
+    ("provsql", "default", "Run Query", {}),
+    ("provsql", "add_provenance", "Run Query", {}),
+    ("provsql", "create_provenance_mapping", "Run Query", {}),
+    (
+        "provsql",
+        "semirings",
+        "Run Query",
+        {"semirings_table": "personnel_name", "semirings_subquery": "SELECT city FROM personnel"},
+    ),
+    (
+        "provsql",
+        "semirings",
+        "Generate Image",
+        {"semirings_table": "personnel_name", "semirings_subquery": "SELECT city FROM personnel"},
+    ),
+    ("provsql", "where_provenance", "Run Query", {"wp_subquery": "SELECT city FROM personnel"}),
+    (
+        "provsql",
+        "probability",
+        "Run Query",
+        {"prob_method": "'monte-carlo', 1000", "prob_subquery": "SELECT city FROM personnel"},
+    ),
+]
+
+QUERIES = {
+    "gprom": "SELECT a, b FROM r WHERE a > 1",
+    "provsql": "SELECT city FROM personnel",
+}
+
+
+# --- Stub engines ---
+
+
+def output_kind(query: str) -> str:
+    upper = query.upper()
+    for needle, kind in (
+        ("SR_FORMULA", "sr_formula"),
+        ("WHERE_PROVENANCE", "where_provenance"),
+        ("PROBABILITY_EVALUATE", "probability"),
+        ("REENACT", "reenact"),
+        ("PROVENANCE", "provenance"),
+    ):
+        if needle in upper:
+            return kind
+    return "default"
+
+
+def ascii_table(columns, rows) -> str:
+    widths = [len(c) for c in columns]
+    for row in rows:
+        for i, v in enumerate(row):
+            widths[i] = max(widths[i], len(v))
+    lines = [" " + " | ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.append("-" + "-+-".join("-" * w for w in widths) + "-")
+    for row in rows:
+        lines.append(" " + " | ".join(v.ljust(w) for v, w in zip(row, widths)))
+    lines.append(f"({len(rows)} rows)")
+    return "\n".join(lines) + "\n\n"
+
+
+def csv_table(columns, rows) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def synthetic_output(kind: str, rows=ROWS, cols=COLS, seed=0, fmt="aligned") -> str:
+    rnd = random.Random(seed)
+    if kind == "graphviz":
+        nodes = max(rows // 50, 5)
+        body = [f'  n{i} [label="op{i}"];' for i in range(nodes)]
+        body += [f"  n{i} -> n{rnd.randrange(i)};" for i in range(1, nodes)]
+        return (
+            "GRAPHVIZ: BEFORE OPTIMIZATIONS\ndigraph G {\n}\n"
+            "GRAPHVIZ: AFTER OPTIMIZATIONS\ndigraph G {\n"
+            + "\n".join(body)
+            + "\n}\n"
+        )
+    columns = ["city"] + [f"c{i}" for i in range(1, cols)]
+    data = []
+    for r in range(rows):
+        row = [rnd.choice(CITIES)] + [str(rnd.randrange(1000)) for _ in columns[1:]]
+        data.append(row)
+    if kind in ("sr_formula", "where_provenance", "probability"):
+        columns = ["city", "provsql", kind]
+        inputs = max(rows // 4, 2)
+        for r, row in enumerate(data):
+            if kind == "sr_formula":
+                terms = [
+                    f"(t{rnd.randrange(inputs)} ⊗ t{rnd.randrange(inputs)})"
+                    for _ in range(rnd.randint(1, 4))
+                ]
+                value = " ⊕ ".join(terms)
+            elif kind == "where_provenance":
+                value = f"{{[personnel:{rnd.randrange(inputs)}:4]}}"
+            else:
+                value = f"{rnd.random():.4f}"
+            data[r] = [row[0], f"uuid-{r}", value]
+    elif kind in ("provenance", "reenact"):
+        columns = columns + [f"prov_r_{c}" for c in columns[1:]]
+        data = [row + row[1:] for row in data]
+    if fmt == "csv":
+        return csv_table(columns, data)
+    return ascii_table(columns, data)
+
+
+def engine_output(engine: str, query: str, fmt="aligned") -> str:
+    kind = output_kind(query)
+    if RECORDINGS:
+        ext = "csv" if fmt == "csv" else "txt"
+        path = os.path.join(RECORDINGS, f"{engine}-{kind}.{ext}")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+    return synthetic_output(kind, fmt=fmt)
+
+
+def run_stub(engine: str, args) -> int:
+    # Entry point of the stub executables
+    if engine == "psql":
+        # docker exec -i provsql-demo psql ... -c <query>
+        query = args[args.index("-c") + 1] if "-c" in args else ""
+        fmt = "csv" if "--csv" in args else "aligned"
+        sys.stdout.write(engine_output("provsql", query, fmt))
+        return 0
+    if "-query" in args:
+        # One-shot gprom with -show_graphviz
+        query = args[args.index("-query") + 1]
+        if "-show_graphviz" in args:
+            sys.stdout.write(synthetic_output("graphviz"))
+        sys.stdout.write(engine_output("gprom", query))
+        return 0
+    # Interactive gprom: one statement per line until \q, sentinel queries
+    # (see gprom_pool.GPROM_SENTINEL_SQL) echo their marker
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        if line == "\\q":
+            break
+        if line.startswith("SELECT '") and "gprom_eoq_" in line:
+            marker = line.split("'")[1]
+            sys.stdout.write(ascii_table([marker], [[marker]]))
+        else:
+            sys.stdout.write(engine_output("gprom", line))
+        sys.stdout.flush()
+    return 0
+
+
+def install_stubs(directory: str):
+    # `gprom` and `docker` executables in `directory` that run this file
+    for name, engine in (("gprom", "gprom"), ("docker", "psql")):
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(
+                "#!/bin/sh\n"
+                f'exec "{sys.executable}" "{os.path.abspath(__file__)}" stub {engine} "$@"\n'
+            )
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = directory + os.pathsep + os.environ.get("PATH", "")
+    os.environ["GPROM_BIN"] = os.path.join(directory, "gprom")
+    os.environ["PROVSQL_BACKEND"] = "docker"
+    os.environ["GRAPH_DIR"] = os.path.join(directory, "graphs")
+
+
+# --- Timing ---
+
+
+def timed(phases: dict, name: str, fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    phases.setdefault(name, []).append(time.perf_counter() - start)
+    return value
+
+
+def summary(samples) -> dict:
+    ms = [s * 1000 for s in samples]
+    return {
+        "min_ms": round(min(ms), 3),
+        "median_ms": round(statistics.median(ms), 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "max_ms": round(max(ms), 3),
+        "runs": len(ms),
+    }
+
+
+def engine_text(app, fields: dict, full_query: str) -> str:
+    # The engine call execute_request makes, output read whole
+    if fields["engine"] == "gprom":
+        if fields["action"] == "Generate Image":
+            return subprocess.run(
+                app.gprom_command("-show_graphviz", "-graphviz_details", "-query", full_query),
+                capture_output=True,
+                text=True,
+            ).stdout
+    # The engine's executor, from the registry (engines.py)
+    return "".join(app.engines.get(fields["engine"]).run(full_query))
+
+
+def end_to_end(app, fields: dict):
+    # The whole request, reading every row like a client paging to the end.
+    # The result is dropped afterwards so its stream (and the gprom worker
+    # or connection behind it) is released.
+    context = app.execute_request(fields)
+    if context["result_id"] is not None:
+        stored = app.results.remove(context["result_id"])
+        if stored is not None:
+            stored.all_rows()
+            stored.close()
+    return context
+
+
+def csv_rows(output: str):
+    from streaming import CsvTable, decode_columns
+
+    table = CsvTable(iter(output.splitlines(True)))
+    return table.columns, list(decode_columns(table.rows()))
+
+
+def run_case(app, case, repeat: int, warmup: int, have_dot: bool) -> dict:
+    from queries import build_query
+    from streaming import StreamingTable, extract_digraph
+    from provsql_pool import PSQL_OUTPUT
+    from result_store import ColumnarResult
+    from summaries import count_values
+    import prov_graph
+
+    engine, mode, action, extra = case
+    form = {"engine": engine, "mode": mode, "action": action, "query": QUERIES[engine]}
+    form.update(extra)
+    fields = app.read_form(form)
+    phases = {}
+
+    for i in range(warmup + repeat):
+        if i == warmup:
+            phases = {}
+        full_query = timed(phases, "build", build_query, fields)
+        output = timed(phases, "engine", engine_text, app, fields, full_query)
+
+        if action == "Generate Image" and engine == "gprom":
+            dot_source, _ = timed(phases, "graph_extract", extract_digraph, iter(output.splitlines(True)))
+            if have_dot and dot_source:
+                timed(phases, "graph_render", app.render_image, dot_source + f"// run {i}\n")
+            columns, rows = [], []
+        else:
+            columns, rows = timed(phases, "parse_table", app.parse_psql_ascii_table, output)
+            timed(phases, "parse_csv", app.parse_csv_like_output, output)
+            timed(
+                phases,
+                "parse_stream",
+                lambda: list(StreamingTable(iter(output.splitlines(True))).rows()),
+            )
+            if engine == "provsql" and PSQL_OUTPUT == "csv":
+                # What the docker backend actually parses
+                columns, rows = timed(phases, "parse_csv_typed", csv_rows, output)
+            if rows:
+                # The page counts the first column of the stored result
+                stored = ColumnarResult(columns, rows)
+                timed(phases, "chart", count_values, stored.column_values(0), None)
+                stored.close()
+
+        if action == "Generate Image" and engine == "provsql" and rows:
+            timed(phases, "graph_build", prov_graph.to_dot, columns, rows)
+            if have_dot:
+                timed(phases, "graph_render", prov_graph.render, columns, rows)
+
+        with app.app.test_request_context("/", method="POST"):
+            context = app.page_context(
+                fields,
+                columns=columns,
+                result=rows[:200],
+                result_type="table" if columns and rows else "raw",
+                full_query=full_query,
+            )
+            timed(phases, "render", app.render_template, "index.html", **context)
+
+        app.result_cache.clear()
+        timed(phases, "end_to_end", end_to_end, app, fields)
+
+    return {
+        "engine": engine,
+        "mode": mode,
+        "action": action,
+        "phases": {name: summary(samples) for name, samples in phases.items()},
+    }
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> bool:
+    # Prints median ratios against a baseline report, True when no phase got
+    # slower than `threshold` times the baseline
+    base = {(c["engine"], c["mode"], c["action"]): c for c in baseline["cases"]}
+    ok = True
+    for case in report["cases"]:
+        old = base.get((case["engine"], case["mode"], case["action"]))
+        if old is None:
+            continue
+        for phase, stats in case["phases"].items():
+            before = old["phases"].get(phase)
+            if not before or not before["median_ms"]:
+                continue
+            ratio = stats["median_ms"] / before["median_ms"]
+            flag = ""
+            if ratio > threshold:
+                flag = "  <-- slower"
+                ok = False
+            print(
+                f"{case['engine']}/{case['mode']}/{case['action']:<15} {phase:<14} "
+                f"{before['median_ms']:>10.3f} -> {stats['median_ms']:>10.3f} ms  x{ratio:.2f}{flag}"
+            )
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the provenance query paths")
+    parser.add_argument("--rows", type=int, default=ROWS)
+    parser.add_argument("--cols", type=int, default=COLS)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--recordings", default=RECORDINGS)
+    parser.add_argument("--only", default="", help="only cases whose engine/mode contains this")
+    parser.add_argument("--output", default="", help="write the JSON report here")
+    parser.add_argument("--compare", default="", help="baseline JSON report")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="provbench-")
+    os.environ["BENCH_ROWS"] = str(args.rows)
+    os.environ["BENCH_COLS"] = str(args.cols)
+    os.environ["BENCH_RECORDINGS"] = os.path.abspath(args.recordings) if args.recordings else ""
+    install_stubs(scratch)
+    sys.path.insert(0, HERE)
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        import app
+
+        if not os.path.exists(os.path.join(app.app.root_path, app.app.template_folder, "index.html")):
+            # Checkouts that keep index.html next to app.py
+            app.app.template_folder = app.app.root_path
+        have_dot = shutil.which("dot") is not None
+
+        cases = []
+        for case in WORKLOAD:
+            name = f"{case[0]}/{case[1]}"
+            if args.only and args.only not in name:
+                continue
+            result = run_case(app, case, args.repeat, args.warmup, have_dot)
+            cases.append(result)
+            e2e = result["phases"]["end_to_end"]["median_ms"]
+            print(f"{name:<36} {case[2]:<15} end_to_end {e2e:>10.3f} ms", file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "rows": args.rows,
+            "cols": args.cols,
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+            "recordings": bool(args.recordings),
+            "graphviz": have_dot,
+            "gprom_workers": int(os.environ.get("GPROM_WORKERS", "2")),
+        },
+        "cases": cases,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "stub":
+        sys.exit(run_stub(sys.argv[2], sys.argv[3:]))
+    sys.exit(main())
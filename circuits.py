@@ -0,0 +1,258 @@
+import csv
+import os
+import re
+import subprocess
+import threading
+import uuid
+from collections import OrderedDict
+from io import StringIO
+
+from jobs import pipe_process
+from metrics import span
+from provsql_pool import get_provsql_pool, psql_command, cancel_backend
+
+
+# Gates kept in memory, least recently used dropped first
+CIRCUIT_CACHE_GATES = int(os.environ.get("CIRCUIT_CACHE_GATES", "200000"))
+# Levels returned per expansion, and a cap on the gates of one response
+CIRCUIT_DEPTH = int(os.environ.get("CIRCUIT_DEPTH", "2"))
+CIRCUIT_MAX_NODES = int(os.environ.get("CIRCUIT_MAX_NODES", "500"))
+# Timeout of one expansion (app.circuit_view) and of one psql call
+CIRCUIT_TIMEOUT = float(os.environ.get("CIRCUIT_TIMEOUT", "60"))
+
+UUID_RE = re.compile(
+    r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
+)
+TABLE_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+# One row per gate: uuid, type, children, info1, info2
+GATE_QUERY = (
+    "SELECT g::text, provsql.get_gate_type(g)::text, "
+    "provsql.get_children(g)::text[], i.info1, i.info2 "
+    "FROM unnest(ARRAY[{ids}]::uuid[]) AS g, provsql.get_infos(g) AS i;"
+)
+# Labels of input gates, read from a provenance mapping (value, provenance)
+LABEL_QUERY = (
+    "SELECT provenance::text, value::text FROM {table} "
+    "WHERE provenance = ANY(ARRAY[{ids}]::uuid[]);"
+)
+
+
+class CircuitError(RuntimeError):
+    # ProvSQL answered with rows of an unexpected shape
+    pass
+
+
+def literal_value(text: str) -> str:
+    # The circuit form takes SQL literals ('...'), the API plain values
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] == "'":
+        text = text[1:-1]
+    return text.strip()
+
+
+def uuid_array(ids) -> str:
+    # ids are checked against UUID_RE, so they can be inlined
+    return ", ".join(f"'{i}'" for i in ids)
+
+
+def parse_array(value):
+    # text[] comes back as a list from psycopg2 and as "{a,b}" from psql
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(str(v) for v in value)
+    value = str(value).strip("{}")
+    return tuple(v.strip('"') for v in value.split(",") if v)
+
+
+def parse_info(value):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def run_sql(sql: str, job=None):
+    # Rows of `sql` on the pooled connection, or through psql --csv in the
+    # ProvSQL container. Cancelling `job` cancels the backend query.
+    pool = get_provsql_pool()
+    if pool is not None:
+        _, rows, _ = pool.execute(sql, job=job)
+        return rows
+    app_name = "provenance_" + uuid.uuid4().hex[:12]
+    remove = job.on_cancel(lambda: cancel_backend(app_name)) if job else None
+    try:
+        out = pipe_process(
+            psql_command(sql, "csv", application_name=app_name),
+            b"",
+            job=job,
+            timeout=CIRCUIT_TIMEOUT,
+        )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(e.stderr.decode("utf-8", "replace").strip() or "psql failed")
+    finally:
+        if remove is not None:
+            remove()
+    rows = list(csv.reader(StringIO(out.decode("utf-8"))))
+    return rows[1:]
+
+
+def check_rows(rows, width, query):
+    # Rows must have `width` columns, anything else is not ProvSQL's answer
+    for row in rows:
+        if len(row) != width:
+            raise CircuitError(
+                f"Unexpected {query} row from ProvSQL: {len(row)} columns, expected {width}"
+            )
+    return rows
+
+
+class CircuitCache:
+    # ProvSQL circuit gates by UUID. A gate's type and children never
+    # change once created, so entries are only dropped for space. Circuits
+    # of different tokens share their sub-circuits, which are fetched once.
+    # Input labels come from a mapping table and follow writes to it.
+    # `run(sql, job=None)` returns the rows of one query.
+
+    def __init__(self, run=run_sql, max_gates=CIRCUIT_CACHE_GATES):
+        self.run = run
+        self.max_gates = max_gates
+        self._gates = OrderedDict()
+        self._labels = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, store, key):
+        with self._lock:
+            value = store.get(key)
+            if value is not None:
+                store.move_to_end(key)
+            return value
+
+    def _put(self, store, key, value):
+        with self._lock:
+            store[key] = value
+            store.move_to_end(key)
+            while len(store) > self.max_gates:
+                store.popitem(last=False)
+
+    def gates(self, ids, job=None):
+        # {uuid: (type, children, info1, info2)}, one query for the misses
+        found = {}
+        missing = []
+        for i in ids:
+            gate = self._get(self._gates, i)
+            if gate is None:
+                missing.append(i)
+            else:
+                found[i] = gate
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            with span("circuit_fetch", "provsql", "semirings") as s:
+                rows = self.run(GATE_QUERY.format(ids=uuid_array(missing)), job=job)
+                s.rows = len(rows)
+            check_rows(rows, 5, "gate")
+            for uid, kind, children, info1, info2 in rows:
+                gate = (str(kind), parse_array(children), parse_info(info1), parse_info(info2))
+                self._put(self._gates, str(uid), gate)
+                found[str(uid)] = gate
+        return found
+
+    def labels(self, table, ids, job=None):
+        # {uuid: value} of input gates found in mapping `table`
+        found = {}
+        missing = []
+        for i in ids:
+            label = self._get(self._labels, (table, i))
+            if label is None:
+                missing.append(i)
+            else:
+                found[i] = label
+        if missing:
+            with span("circuit_labels", "provsql", "semirings") as s:
+                rows = self.run(
+                    LABEL_QUERY.format(table=table, ids=uuid_array(missing)), job=job
+                )
+                s.rows = len(rows)
+            check_rows(rows, 2, "label")
+            labelled = {str(uid): str(value) for uid, value in rows}
+            for uid in missing:
+                # Unmapped inputs are remembered too, as ""
+                value = labelled.get(uid, "")
+                self._put(self._labels, (table, uid), value)
+                found[uid] = value
+        return found
+
+    def expand(
+        self, root, depth=CIRCUIT_DEPTH, mapping=None, max_nodes=CIRCUIT_MAX_NODES, job=None
+    ):
+        # Gates reachable from `root` within `depth` levels, breadth first,
+        # one query per level for the gates not cached yet. Children of the
+        # last level are listed but not included; expanding them is another
+        # call with that child as root.
+        if not UUID_RE.match(root):
+            raise ValueError("not a UUID: " + root)
+        if mapping and not TABLE_RE.match(mapping):
+            raise ValueError("not a table name: " + mapping)
+        nodes = {}
+        frontier = [root.lower()]
+        truncated = False
+        for _ in range(depth + 1):
+            if not frontier:
+                break
+            if len(nodes) + len(frontier) > max_nodes:
+                frontier = frontier[: max(max_nodes - len(nodes), 0)]
+                truncated = True
+            found = self.gates(frontier, job=job)
+            next_level = []
+            queued = set()
+            for uid in frontier:
+                gate = found.get(uid)
+                if gate is None:
+                    continue
+                kind, children, info1, info2 = gate
+                nodes[uid] = {
+                    "type": kind,
+                    "children": list(children),
+                    "info": [info1, info2],
+                }
+                for child in children:
+                    if child not in nodes and child not in queued:
+                        queued.add(child)
+                        next_level.append(child)
+            frontier = [c for c in next_level if c not in nodes]
+            if truncated:
+                break
+        if root.lower() not in nodes:
+            raise KeyError(root)
+
+        if mapping:
+            inputs = [uid for uid, n in nodes.items() if n["type"] == "input"]
+            if inputs:
+                for uid, value in self.labels(mapping, inputs, job=job).items():
+                    if value:
+                        nodes[uid]["label"] = value
+        return {"root": root.lower(), "depth": depth, "nodes": nodes, "truncated": truncated}
+
+    def invalidate_table(self, table):
+        with self._lock:
+            for key in [k for k in self._labels if k[0].lower() == table.lower()]:
+                del self._labels[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "gates": len(self._gates),
+                "labels": len(self._labels),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+circuits = CircuitCache()
@@ -0,0 +1,232 @@
+import importlib
+import os
+import threading
+
+from metrics import span
+
+
+# Engines to warm at startup (comma separated, see warm), e.g. "gprom,provsql"
+ENGINE_WARMUP = os.environ.get("ENGINE_WARMUP", "")
+# More engines, "name=module:attribute,...", attribute being an Engine
+ENGINE_PLUGINS = os.environ.get("ENGINE_PLUGINS", "")
+
+
+def load(spec: str):
+    # "module:attribute", imported on first use
+    module, _, attribute = spec.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+# Mode every engine offers: the query as it is written
+DEFAULT_MODE = ("default", "Default (normal SQL)")
+
+# Parsers of output lines by format, for engines that name none
+PARSERS = {"aligned": "streaming:StreamingTable", "csv": "streaming:TypedCsvTable"}
+
+
+def form_modes(modes):
+    # (value, label) of an engine's modes for the form, the default first
+    return [DEFAULT_MODE] + [m for m in modes if m[0] != DEFAULT_MODE[0]]
+
+
+class Engine:
+    # One provenance engine. The parts are "module:attribute" names,
+    # resolved the first time they are needed:
+    #   build     fields -> SQL to run
+    #   identity  () -> the database behind it (part of result cache keys)
+    #   pool      () -> shared pool with warm(), or None
+    #   run       (full_query, job) -> (columns, rows), (columns, rows,
+    #             status) for statements that ran to completion, or lines
+    #             of output
+    #   parse     lines -> table with text, found, columns, rows() and
+    #             close() (see streaming.StreamingTable); by default the
+    #             parser of `output` ("aligned" or "csv")
+    # Connections, gprom processes and psycopg2 are opened or imported when
+    # first used, plugin modules as well.
+    # `modes` lists (value, label) of the engine's modes for the form, the
+    # default mode is always offered; app.run_request handles the modes and
+    # actions that need more than one query (images, circuits, parallel
+    # probabilities, re-enactment reuse).
+
+    def __init__(
+        self,
+        name,
+        label,
+        build,
+        identity=None,
+        pool=None,
+        run=None,
+        modes=(),
+        output="aligned",
+        parse=None,
+    ):
+        self.name = name
+        self.label = label
+        self.modes = form_modes(modes)
+        self.output = output
+        self._specs = {
+            "build": build,
+            "identity": identity,
+            "pool": pool,
+            "run": run,
+            "parse": parse or PARSERS[output],
+        }
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def part(self, name):
+        loaded = self._loaded.get(name)
+        if loaded is None and self._specs[name] is not None:
+            with self._lock:
+                loaded = self._loaded.get(name)
+                if loaded is None:
+                    with span("engine_load", self.name, ""):
+                        loaded = load(self._specs[name])
+                    self._loaded[name] = loaded
+        return loaded
+
+    def build(self, fields: dict) -> str:
+        return self.part("build")(fields)
+
+    def identity(self) -> str:
+        identity = self.part("identity")
+        return identity() if identity is not None else self.name
+
+    def pool(self):
+        pool = self.part("pool")
+        return pool() if pool is not None else None
+
+    def run(self, full_query: str, job=None):
+        run = self.part("run")
+        if run is None:
+            raise RuntimeError(f"Engine {self.name} has no executor")
+        return run(full_query, job)
+
+    def parse(self, lines):
+        return self.part("parse")(lines)
+
+    def warm(self):
+        # Imports the engine and opens its connections or processes
+        for name in self._specs:
+            self.part(name)
+        pool = self.pool()
+        if pool is not None:
+            with span("engine_warm", self.name, ""):
+                pool.warm()
+
+
+class EngineRegistry:
+    def __init__(self):
+        self._engines = {}
+        self._plugins = {}
+        self._lock = threading.Lock()
+
+    def register(self, engine):
+        self._engines[engine.name] = engine
+        return engine
+
+    def register_plugin(self, name, spec, label=None, modes=()):
+        # The Engine object itself lives in a module loaded on first use,
+        # until then the form lists it with `label` and `modes`
+        self._plugins[name] = (spec, label or name, form_modes(modes))
+
+    def get(self, name) -> Engine:
+        engine = self._engines.get(name)
+        if engine is None and name in self._plugins:
+            with self._lock:
+                engine = self._engines.get(name)
+                if engine is None:
+                    engine = self.register(load(self._plugins[name][0]))
+                    del self._plugins[name]
+        if engine is None:
+            raise KeyError(f"Unknown engine: {name}")
+        return engine
+
+    def __contains__(self, name):
+        return name in self._engines or name in self._plugins
+
+    def all(self):
+        # Every engine, loading the plugins
+        for name in list(self._plugins):
+            self.get(name)
+        return list(self._engines.values())
+
+    def choices(self):
+        # {name, label, modes} for the form, plugins are not loaded
+        with self._lock:
+            listed = [
+                {"name": e.name, "label": e.label, "modes": e.modes}
+                for e in self._engines.values()
+            ]
+            listed += [
+                {"name": name, "label": label, "modes": modes}
+                for name, (_, label, modes) in self._plugins.items()
+            ]
+        return listed
+
+    def warm(self, names):
+        # Failures are left for the first query to report
+        for name in names:
+            try:
+                self.get(name).warm()
+            except Exception:
+                pass
+
+    def warm_in_background(self, names=None):
+        names = [n.strip() for n in (names or ENGINE_WARMUP).split(",") if n.strip()]
+        if names:
+            threading.Thread(
+                target=self.warm, args=(names,), name="engine-warm", daemon=True
+            ).start()
+
+
+engines = EngineRegistry()
+engines.register(
+    Engine(
+        "gprom",
+        "GProM",
+        build="queries:build_gprom_query",
+        identity="gprom_pool:database_identity",
+        pool="gprom_pool:get_gprom_pool",
+        run="gprom_pool:run_query",
+        parse="streaming:StreamingTable",
+        modes=[
+            ("provenance", "PROVENANCE OF (...)"),
+            ("timestamp", "PROVENANCE AS OF TIMESTAMP (...)"),
+            ("baserelation", "PROVENANCE WITH BASERELATION"),
+            ("has_provenance", "HAS PROVENANCE (...)"),
+            ("use_provenance", "USE PROVENANCE (...)"),
+            ("reenact", "REENACT (...)"),
+            ("reenact_provenance", "REENACT WITH PROVENANCE (...)"),
+            ("reenact_annotations", "REENACT + ANNOTATIONS"),
+        ],
+    )
+)
+engines.register(
+    Engine(
+        "provsql",
+        "ProvSQL",
+        build="queries:build_provsql_query",
+        identity="provsql_pool:database_identity",
+        pool="provsql_pool:get_provsql_pool",
+        run="provsql_pool:run_query",
+        parse="provsql_pool:psql_table",
+        modes=[
+            ("add_provenance", "SELECT ADD_PROVENANCE ('table1')"),
+            (
+                "create_provenance_mapping",
+                "SELECT CREATE_PROVENANCE_MAPPING ('table1', 'table2', 'table3')",
+            ),
+            ("semirings", "SELECT *, SR_FORMULA (PROVENANCE(), 'table') FROM (SUBQUERY)"),
+            ("where_provenance", "SELECT *, WHERE_PROVENANCE(...) FROM (SUBQUERY)"),
+            (
+                "probability",
+                "SELECT *, SR_PROBABILITY (provenance, 'param1', 'opt-param2') FROM (SUBQUERY)",
+            ),
+        ],
+    )
+)
+for item in ENGINE_PLUGINS.split(","):
+    name, found, spec = item.strip().partition("=")
+    if found:
+        engines.register_plugin(name.strip(), spec.strip())
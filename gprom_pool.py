@@ -0,0 +1,410 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+import uuid
+
+from streaming import iter_process_lines
+
+
+# GProM command line settings (override with environment variables)
+GPROM_BIN = os.environ.get("GPROM_BIN", "/home/user/gprom/src/command_line/gprom")
+GPROM_DB = os.environ.get("GPROM_DB", "gprom_db")
+GPROM_HOST = os.environ.get("GPROM_HOST", "localhost")
+GPROM_PORT = os.environ.get("GPROM_PORT", "5432")
+GPROM_USER = os.environ.get("GPROM_USER", "postgres")
+GPROM_ARGS = [
+    "-db",
+    GPROM_DB,
+    "-backend",
+    "postgres",
+    "-host",
+    GPROM_HOST,
+    "-port",
+    GPROM_PORT,
+    "-user",
+    GPROM_USER,
+]
+# psql used to cancel gprom's backend queries (see cancel_backend)
+GPROM_PSQL = os.environ.get("GPROM_PSQL", "psql")
+GPROM_WORKERS = int(os.environ.get("GPROM_WORKERS", "2"))
+GPROM_QUERY_TIMEOUT = float(os.environ.get("GPROM_QUERY_TIMEOUT", "120"))
+# Seconds between pings of idle workers, 0 turns the health check off
+GPROM_HEALTH_INTERVAL = float(os.environ.get("GPROM_HEALTH_INTERVAL", "60"))
+
+# Sent after every query. The marker shows up in the header (alias) and in the
+# value row of its output, which is how the end of the real output is found.
+GPROM_SENTINEL_SQL = os.environ.get(
+    "GPROM_SENTINEL_SQL", "SELECT '{marker}' AS {marker};"
+)
+# How long to wait for the sentinel value row once its header was seen
+SENTINEL_GRACE = 1.0
+
+
+def gprom_command(*extra):
+    return [GPROM_BIN, *GPROM_ARGS, *extra]
+
+
+def gprom_env(application_name):
+    # gprom connects through libpq, which takes the application name of its
+    # backend connection from PGAPPNAME
+    return dict(os.environ, PGAPPNAME=application_name)
+
+
+def application_name():
+    return "provenance_gprom_" + uuid.uuid4().hex[:12]
+
+
+def cancel_backend(application_name, timeout=10):
+    # Killing gprom leaves the query it sent running in the database, so
+    # the backend query is cancelled by name
+    sql = (
+        "SELECT pg_cancel_backend(pid) FROM pg_stat_activity "
+        f"WHERE application_name = '{application_name}';"
+    )
+    command = [GPROM_PSQL, "-h", GPROM_HOST, "-p", GPROM_PORT, "-U", GPROM_USER]
+    try:
+        subprocess.run(
+            command + ["-d", GPROM_DB, "-c", sql],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+
+class GPromError(Exception):
+    pass
+
+
+class GPromTimeout(GPromError):
+    pass
+
+
+class GPromWorkerDied(GPromError):
+    pass
+
+
+class GPromWorker:
+    # One interactive gprom process holding one backend connection.
+    # stdout is pumped into a queue by a reader thread so reads can time out.
+
+    def __init__(self, command=None, sentinel_sql=GPROM_SENTINEL_SQL):
+        self.command = command or gprom_command()
+        self.sentinel_sql = sentinel_sql
+        self.process = None
+        self.queries = 0
+        self.application_name = None
+        self._lines = None
+
+    def start(self):
+        # A new name per process, so cancelling a dead worker's query cannot
+        # hit the query of its replacement
+        self.application_name = application_name()
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            env=gprom_env(self.application_name),
+        )
+        self._lines = queue.Queue()
+        threading.Thread(
+            target=self._pump, args=(self.process.stdout, self._lines), daemon=True
+        ).start()
+        self.queries = 0
+
+    @staticmethod
+    def _pump(stream, lines):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)  # EOF, process exited
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write("\\q\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=2)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def abort(self):
+        # Kills gprom and cancels the query it left running in the database
+        name, self.application_name = self.application_name, None
+        self.kill()
+        if name:
+            cancel_backend(name)
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def _drain(self):
+        # Drop anything left over from an earlier query (late sentinel rows)
+        while True:
+            try:
+                if self._lines.get_nowait() is None:
+                    raise GPromWorkerDied("gprom exited")
+            except queue.Empty:
+                return
+
+    def iter_lines(self, query, timeout=GPROM_QUERY_TIMEOUT):
+        # Yields output lines of `query` as gprom produces them and stops at
+        # the sentinel. `timeout` bounds each wait for the next line, not the
+        # whole output (JOB_TIMEOUT does that), so a slow reader of a large
+        # result does not time out.
+        if not self.alive():
+            raise GPromWorkerDied("gprom is not running")
+        self._drain()
+        marker = "gprom_eoq_" + uuid.uuid4().hex[:12]
+        try:
+            self.process.stdin.write(
+                query + "\n" + self.sentinel_sql.format(marker=marker) + "\n"
+            )
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise GPromWorkerDied(str(e))
+
+        deadline = time.monotonic() + timeout
+        pending = []
+        seen_marker = False
+        while True:
+            if seen_marker:
+                wait = SENTINEL_GRACE
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    raise GPromTimeout(f"gprom did not answer within {timeout}s")
+            try:
+                line = self._lines.get(timeout=wait)
+            except queue.Empty:
+                if seen_marker:
+                    break
+                raise GPromTimeout(f"gprom did not answer within {timeout}s")
+            deadline = time.monotonic() + timeout
+            if line is None:
+                raise GPromWorkerDied("gprom exited while running a query")
+            if marker in line:
+                if seen_marker:
+                    break
+                seen_marker = True
+                continue
+            if seen_marker:
+                # Separator of the sentinel table
+                continue
+            # Hold back blank lines so the gap before the sentinel is dropped
+            if not line.strip():
+                pending.append(line)
+                continue
+            for p in pending:
+                yield p
+            pending = []
+            yield line
+        self.queries += 1
+
+    def run(self, query, timeout=GPROM_QUERY_TIMEOUT):
+        return "".join(self.iter_lines(query, timeout))
+
+    def ping(self, timeout=10):
+        # Health check: the sentinel alone must round-trip
+        try:
+            self.run("", timeout)
+            return True
+        except GPromError:
+            return False
+
+
+class GPromPool:
+    # Queue of persistent gprom workers. Each query checks out an idle worker,
+    # crashed or hung workers are killed and restarted on their next checkout.
+
+    def __init__(self, size=GPROM_WORKERS, command=None, timeout=GPROM_QUERY_TIMEOUT):
+        self.size = size
+        self.command = command
+        self.timeout = timeout
+        self.workers = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            grow = len(self.workers) < self.size
+            if grow:
+                worker = GPromWorker(self.command)
+                self.workers.append(worker)
+        if grow:
+            try:
+                worker.start()
+                # Consumes the startup banner as well
+                worker.ping(timeout=self.timeout)
+            except Exception:
+                with self._lock:
+                    self.workers.remove(worker)
+                worker.stop()
+                raise
+            return worker
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise GPromTimeout(f"No free gprom worker within {self.timeout:g}s") from None
+
+    def _release(self, worker, failed=False):
+        # A failed worker is killed here, with its backend query, and
+        # restarted on its next checkout
+        if failed:
+            worker.abort()
+        self._idle.put(worker)
+
+    def iter_lines(self, query, timeout=None, job=None):
+        # The worker running this query is killed and its backend query
+        # cancelled when `job` is cancelled or times out (used by the job
+        # subsystem)
+        worker = self._acquire()
+        failed = False
+        remove = None
+        try:
+            if not worker.alive():
+                worker.restart()
+                worker.ping(timeout=self.timeout)
+            if job is not None:
+                # Removed before the worker serves another query
+                remove = job.on_cancel(worker.abort)
+                job.check()
+            yield from worker.iter_lines(query, timeout or self.timeout)
+        except GeneratorExit:
+            # Caller stopped reading, the rest of the output is still queued
+            failed = True
+            raise
+        except GPromError:
+            failed = True
+            raise
+        finally:
+            if remove is not None:
+                remove()
+            self._release(worker, failed)
+
+    def run(self, query, timeout=None, job=None):
+        return "".join(self.iter_lines(query, timeout, job))
+
+    def warm(self):
+        # Starts every worker now rather than on the first queries
+        started = []
+        try:
+            for _ in range(self.size):
+                started.append(self._acquire())
+        finally:
+            for worker in started:
+                self._release(worker)
+        return len(started)
+
+    def health_check(self):
+        # Ping idle workers and restart the ones that do not answer. One
+        # worker is taken out at a time, the others keep serving queries.
+        # Returns (healthy, restarted).
+        healthy = restarted = 0
+        for _ in range(self._idle.qsize()):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.alive() and worker.ping():
+                healthy += 1
+                self._idle.put(worker)
+            else:
+                restarted += 1
+                worker.abort()
+                try:
+                    worker.start()
+                    worker.ping(timeout=self.timeout)
+                except Exception:
+                    worker.kill()
+                self._idle.put(worker)
+        return healthy, restarted
+
+    def start_health_checks(self, interval=GPROM_HEALTH_INTERVAL):
+        # Background thread running health_check every `interval` seconds,
+        # so a hung idle worker is replaced before a query picks it
+        if interval <= 0 or self._checker is not None:
+            return
+        self._checker = threading.Thread(
+            target=self._check_loop, args=(interval,), name="gprom-health", daemon=True
+        )
+        self._checker.start()
+
+    def _check_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.health_check()
+            except Exception:
+                pass
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def database_identity():
+    return f"gprom:{GPROM_HOST}:{GPROM_PORT}/{GPROM_DB}"
+
+
+def run_query(full_query, job=None):
+    # Executor of the gprom engine (see engines.py): output lines from a
+    # pooled worker, or from a gprom started for this query when
+    # GPROM_WORKERS=0. Cancelling `job` stops gprom and its backend query.
+    pool = get_gprom_pool()
+    if pool is not None:
+        return pool.iter_lines(full_query, job=job)
+    name = application_name()
+    process = subprocess.Popen(
+        gprom_command(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=gprom_env(name),
+    )
+    if job is not None:
+        job.on_cancel(process.kill)
+        job.on_cancel(lambda: cancel_backend(name))
+    process.stdin.write(full_query + "\n\\q\n")
+    process.stdin.close()
+    return iter_process_lines(process)
+
+
+def get_gprom_pool():
+    # Shared worker pool, None when GPROM_WORKERS=0 (one gprom per query)
+    global _pool
+    if GPROM_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = GPromPool()
+            _pool.start_health_checks()
+        return _pool
@@ -0,0 +1,62 @@
+import hashlib
+import os
+import threading
+
+from jobs import pipe_process
+from metrics import span
+
+
+# Rendered GProM graphs, one file per distinct DOT source
+GRAPH_DIR = os.environ.get("GRAPH_DIR", os.path.join("static", "graphs"))
+# Oldest images are removed past this many files
+GRAPH_KEEP = int(os.environ.get("GRAPH_KEEP", "200"))
+GRAPH_FORMAT = "png"
+
+
+def image_name(dot_source: str) -> str:
+    digest = hashlib.sha256(dot_source.encode("utf-8")).hexdigest()
+    return f"{digest[:32]}.{GRAPH_FORMAT}"
+
+
+def render_image(dot_source: str, job=None) -> str:
+    # Lays out `dot_source` with Graphviz over stdin/stdout and returns the
+    # file name under GRAPH_DIR. Names are content addressed, so concurrent
+    # requests never overwrite each other and repeated graphs are not
+    # rendered again.
+    name = image_name(dot_source)
+    path = os.path.join(GRAPH_DIR, name)
+    if os.path.exists(path):
+        os.utime(path)
+        return name
+
+    with span("graph_layout") as s:
+        image = pipe_process(
+            ["dot", f"-T{GRAPH_FORMAT}"], dot_source.encode("utf-8"), job=job
+        )
+        s.bytes = len(image)
+    os.makedirs(GRAPH_DIR, exist_ok=True)
+    # Write under a temporary name first so readers never see half a file.
+    # The name is per thread, jobs rendering the same graph write their own.
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(image)
+    os.replace(tmp, path)
+    prune()
+    return name
+
+
+def prune(keep=GRAPH_KEEP):
+    try:
+        entries = [
+            e for e in os.scandir(GRAPH_DIR) if e.name.endswith("." + GRAPH_FORMAT)
+        ]
+    except FileNotFoundError:
+        return
+    if len(entries) <= keep:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for e in entries[: len(entries) - keep]:
+        try:
+            os.remove(e.path)
+        except OSError:
+            pass
@@ -0,0 +1,358 @@
+import os
+import pickle
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Job settings (override with environment variables)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", "300"))
+# How long the query page waits for a job before switching to polling
+JOB_WAIT = float(os.environ.get("JOB_WAIT", "10"))
+# Finished jobs are kept this long so their results can still be fetched
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", "900"))
+# Job states shared by the worker processes of server.py
+JOB_DIR = os.environ.get("JOB_DIR", "")
+# How often running jobs look for cancel requests from other processes
+JOB_POLL = float(os.environ.get("JOB_POLL", "0.5"))
+
+FINISHED = {"done", "failed", "cancelled", "timeout"}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # A query running in the job executor. Code running inside a job
+    # registers cancel hooks (kill a child process, cancel a backend query),
+    # which run when the job is cancelled or hits its timeout. A hook must be
+    # removed once its process or connection is done with the job, pooled
+    # ones go on to serve other jobs.
+
+    def __init__(self, timeout=JOB_TIMEOUT):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"
+        self.progress = ""
+        self.timeout = timeout
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.cancel_reason = None
+        self._published = None
+        self._hooks = []
+        self._ready = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def on_cancel(self, hook):
+        # Returns a function that removes the hook again
+        with self._lock:
+            if self.cancel_reason is None:
+                self._hooks.append(hook)
+                return lambda: self._remove_hook(hook)
+        # Already cancelled, stop the new work right away
+        hook()
+        return lambda: None
+
+    def _remove_hook(self, hook):
+        with self._lock:
+            if hook in self._hooks:
+                self._hooks.remove(hook)
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._done.is_set() or self.cancel_reason is not None:
+                return False
+            self.cancel_reason = reason
+            hooks, self._hooks = self._hooks, []
+        for hook in hooks:
+            try:
+                hook()
+            except Exception:
+                pass
+        return True
+
+    def check(self):
+        if self.cancel_reason is not None:
+            raise JobCancelled(self.cancel_reason)
+
+    def set_progress(self, text):
+        # Current stage, e.g. "waiting for a gprom slot" or "5000 rows read"
+        self.check()
+        self.progress = text
+
+    def publish(self, result):
+        # A result shown before the job ends, e.g. the first page of rows
+        # while the rest is still read into the result store
+        self.result = result
+        self._ready.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def wait_result(self, timeout=None):
+        # Until a result is published or the job ends
+        return self._ready.wait(timeout)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def info(self):
+        end = self.finished or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "elapsed": round(end - (self.started or end), 3),
+            "queued": round((self.started or end) - self.created, 3),
+            "timeout": self.timeout,
+            "error": self.error,
+            "ready": self.ready,
+        }
+
+
+def pipe_process(args, data, job=None, timeout=None):
+    # Feeds `data` to the child's stdin and returns its stdout, the child is
+    # killed when `job` is cancelled
+    process = subprocess.Popen(
+        args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    remove = job.on_cancel(process.kill) if job is not None else None
+    try:
+        out, err = process.communicate(data, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        if remove is not None:
+            remove()
+    if job is not None:
+        job.check()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, out, err)
+    return out
+
+
+class JobSnapshot:
+    # A job of another process, as it last published it to the job
+    # directory. Cancelling leaves a request the owning process picks up.
+
+    def __init__(self, manager, state):
+        self._manager = manager
+        self.id = state["id"]
+        self.status = state["status"]
+        self.timeout = state["info"]["timeout"]
+        self.result = state["result"]
+        self.error = state["info"]["error"]
+        self.fields = state["fields"]
+        self._info = state["info"]
+        self.cancel_reason = None
+
+    def info(self):
+        return dict(self._info, ready=self.done)
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.done:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(JOB_POLL)
+            latest = self._manager.get(self.id)
+            if latest is not None:
+                self.__dict__.update(latest.__dict__)
+        return True
+
+    @property
+    def ready(self):
+        return self.done
+
+    def wait_result(self, timeout=None):
+        # Results of other processes are only published once the job ends
+        return self.wait(timeout)
+
+    def cancel(self, reason="cancelled"):
+        return not self.done and self._manager.request_cancel(self.id)
+
+
+class JobManager:
+    # Runs jobs on a thread pool, each with its own timeout. Threads only
+    # wait on gprom/psql/backend I/O, so threads are enough here. With
+    # `directory` set, each job's state is published there so the other
+    # processes sharing it can report, show and cancel it.
+
+    def __init__(
+        self,
+        workers=JOB_WORKERS,
+        timeout=JOB_TIMEOUT,
+        retention=JOB_RETENTION,
+        directory=JOB_DIR or None,
+    ):
+        self.timeout = timeout
+        self.retention = retention
+        self.directory = directory
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def submit(self, fn, *args, timeout=None):
+        # fn is called as fn(*args, job=job), its return value becomes
+        # job.result
+        self.sweep()
+        job = Job(timeout or self.timeout)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._publish(job)
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        if job.cancel_reason is not None:
+            self._finish(job)
+            return
+        job.status = "running"
+        job.started = time.time()
+        self._publish(job)
+        self._watch()
+        timer = threading.Timer(job.timeout, job.cancel, args=("timeout",))
+        timer.daemon = True
+        timer.start()
+        try:
+            job.result = fn(*args, job=job)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            job.error = str(e)
+        finally:
+            timer.cancel()
+            self._finish(job)
+
+    def _finish(self, job):
+        if job.cancel_reason is not None:
+            job.status = "timeout" if job.cancel_reason == "timeout" else "cancelled"
+        elif job.error is not None:
+            job.status = "failed"
+        else:
+            job.status = "done"
+        job.finished = time.time()
+        try:
+            self._publish(job)
+        finally:
+            job._ready.set()
+            job._done.set()
+
+    # --- Shared job directory ---
+    def _path(self, job_id, suffix=".pkl"):
+        return os.path.join(self.directory, job_id + suffix)
+
+    def _publish(self, job):
+        if not self.directory:
+            return
+        job._published = job.progress
+        state = {
+            "id": job.id,
+            "status": job.status,
+            "info": job.info(),
+            "result": job.result if job.status in FINISHED else None,
+            "fields": getattr(job, "fields", None),
+        }
+        try:
+            data = pickle.dumps(state)
+        except Exception:
+            # Unpicklable result, other processes only see the status
+            state["result"] = None
+            data = pickle.dumps(state)
+        tmp = f"{self._path(job.id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(job.id))
+
+    def _load(self, job_id):
+        if not self.directory or not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id), "rb") as f:
+                return JobSnapshot(self, pickle.load(f))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def request_cancel(self, job_id):
+        if self._load(job_id) is None:
+            return False
+        with open(self._path(job_id, ".cancel"), "w"):
+            pass
+        return True
+
+    def _watch(self):
+        # One thread per process turns cancel requests into job.cancel()
+        # and publishes the progress of running jobs
+        if not self.directory:
+            return
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(
+                target=self._watch_loop, name="job-watch", daemon=True
+            )
+            self._watcher.start()
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(JOB_POLL)
+            with self._lock:
+                running = [j for j in self._jobs.values() if not j.done]
+            for job in running:
+                if os.path.exists(self._path(job.id, ".cancel")):
+                    job.cancel()
+                elif job.status == "running" and job.progress != job._published:
+                    try:
+                        self._publish(job)
+                    except OSError:
+                        pass
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._load(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        return job is not None and job.cancel()
+
+    def sweep(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            for job_id in [
+                k
+                for k, j in self._jobs.items()
+                if j.done and j.finished < cutoff
+            ]:
+                del self._jobs[job_id]
+        if self.directory:
+            for entry in os.scandir(self.directory):
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+jobs = JobManager()
@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, limits then apply per process
+    fcntl = None
+
+from metrics import span
+
+
+# Queries running at once per engine, 0 for no limit. With ENGINE_LOCK_DIR
+# set (see server.py) the limit holds across every worker process.
+ENGINE_LIMITS = {
+    "gprom": int(os.environ.get("ENGINE_LIMIT_GPROM", "0")),
+    "provsql": int(os.environ.get("ENGINE_LIMIT_PROVSQL", "0")),
+}
+ENGINE_LOCK_DIR = os.environ.get("ENGINE_LOCK_DIR", "")
+# How often a waiting query retries for a free slot
+ENGINE_LIMIT_POLL = float(os.environ.get("ENGINE_LIMIT_POLL", "0.05"))
+
+
+class EngineLimit:
+    # `slots` concurrent queries on one engine. Slots are lock files in
+    # `directory` (flock, released by the kernel if a process dies), or a
+    # semaphore of this process without one. Waiting stops when the job
+    # waiting for a slot is cancelled.
+
+    def __init__(self, name, slots, directory=ENGINE_LOCK_DIR or None):
+        self.name = name
+        self.slots = slots
+        self.directory = directory if fcntl is not None else None
+        self._semaphore = threading.BoundedSemaphore(max(slots, 1))
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _try_file_slot(self):
+        for i in range(self.slots):
+            path = os.path.join(self.directory, f"{self.name}-{i}.lock")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    @contextmanager
+    def slot(self, job=None):
+        if self.slots <= 0:
+            yield
+            return
+        with span("engine_wait"):
+            while True:
+                if self.directory:
+                    fd = self._try_file_slot()
+                    if fd is not None:
+                        break
+                elif self._semaphore.acquire(timeout=ENGINE_LIMIT_POLL):
+                    fd = None
+                    break
+                if job is not None:
+                    job.check()
+                if self.directory:
+                    time.sleep(ENGINE_LIMIT_POLL)
+        try:
+            yield
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            else:
+                self._semaphore.release()
+
+
+limits = {name: EngineLimit(name, slots) for name, slots in ENGINE_LIMITS.items()}
+
+
+@contextmanager
+def engine_slot(engine, job=None):
+    limit = limits.get(engine)
+    if limit is None:
+        yield
+        return
+    with limit.slot(job):
+        yield
@@ -0,0 +1,398 @@
+import atexit
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# Latency buckets in seconds, from a cache hit to a long provenance rewrite
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# With several worker processes (server.py), each one writes its metrics to
+# METRICS_DIR every METRICS_FLUSH seconds and /metrics adds them all up
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+METRICS_FLUSH = float(os.environ.get("METRICS_FLUSH", "5"))
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{n}="{v}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# Metrics are collected as {labels: value} and rendered from the series of
+# every worker. `merge` adds the series of one worker to the total.
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self._lock:
+            return {
+                labels: [list(counts), total, n]
+                for labels, (counts, total, n) in self._series.items()
+            }
+
+    @staticmethod
+    def merge(total, series):
+        for labels, (counts, sum_, n) in series.items():
+            seen = total.get(labels)
+            if seen is None:
+                total[labels] = [list(counts), sum_, n]
+            else:
+                seen[0] = [a + b for a, b in zip(seen[0], counts)]
+                seen[1] += sum_
+                seen[2] += n
+
+    def render(self, series):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, n) in sorted(series.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                text = _label_text(self.labels + ("le",), labels + (f"{bound:g}",))
+                lines.append(f"{self.name}_bucket{text} {cumulative}")
+            text = _label_text(self.labels + ("le",), labels + ("+Inf",))
+            lines.append(f"{self.name}_bucket{text} {n}")
+            text = _label_text(self.labels, labels)
+            lines.append(f"{self.name}_sum{text} {total:.6f}")
+            lines.append(f"{self.name}_count{text} {n}")
+        return lines
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, series):
+        for labels, value in series.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def render(self, series):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(series.items()):
+            lines.append(f"{self.name}{_label_text(self.labels, labels)} {value}")
+        return lines
+
+
+class CounterFunc(Counter):
+    # Count kept elsewhere (e.g. cache hits), read from `fn` when collected.
+    # It only grows while the worker runs, so workers are added up.
+    def __init__(self, name, help, fn):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def collect(self):
+        try:
+            return {(): self.fn()}
+        except Exception:
+            return {}
+
+
+class Gauge:
+    # Value read from `fn` when /metrics is scraped. Workers are not added
+    # up, each live worker is shown with its `pid`.
+    kind = "gauge"
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def collect(self):
+        try:
+            return {(): self.fn()}
+        except Exception:
+            return {}
+
+    @staticmethod
+    def merge(total, series):
+        total.update(series)
+
+    def render(self, series):
+        if not series:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(series.items()):
+            names = ("pid",) if labels else ()
+            lines.append(f"{self.name}{_label_text(names, labels)} {value}")
+        return lines
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def collect():
+    # {metric name: {labels: value}} of this process
+    return {metric.name: metric.collect() for metric in REGISTRY}
+
+
+# --- Metrics of other workers (METRICS_DIR) ---
+# One file per process, named by pid and a per-process id. Files of dead
+# workers are kept, their counts stay in the totals, only their gauges go.
+_file_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_flusher = None
+_flush_lock = threading.Lock()
+
+
+def _metrics_path(directory):
+    return os.path.join(directory, f"{_file_id}.json")
+
+
+def flush(directory=METRICS_DIR):
+    # Writes this process's metrics for the other workers
+    if not directory:
+        return
+    state = {
+        "pid": os.getpid(),
+        "metrics": {
+            name: [[list(labels), value] for labels, value in series.items()]
+            for name, series in collect().items()
+        },
+    }
+    path = _metrics_path(directory)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with _flush_lock:
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _other_workers(directory):
+    # [(pid, alive, {metric name: {labels: value}})] read from METRICS_DIR
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    own = f"{_file_id}.json"
+    workers = []
+    for name in names:
+        if not name.endswith(".json") or name == own:
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        series = {
+            metric: {tuple(labels): value for labels, value in values}
+            for metric, values in state.get("metrics", {}).items()
+        }
+        pid = state.get("pid", 0)
+        workers.append((pid, _alive(pid), series))
+    return workers
+
+
+def _flush_loop(directory, interval):
+    while True:
+        time.sleep(interval)
+        flush(directory)
+
+
+def start_flushing(directory=METRICS_DIR, interval=METRICS_FLUSH):
+    # Background thread writing this worker's metrics, and a last write
+    # when the worker exits
+    global _flusher
+    if not directory or interval <= 0 or _flusher is not None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    atexit.register(flush, directory)
+    _flusher = threading.Thread(
+        target=_flush_loop, args=(directory, interval), name="metrics-flush", daemon=True
+    )
+    _flusher.start()
+
+
+def render(directory=METRICS_DIR):
+    # Prometheus text exposition format, over every worker when `directory`
+    # is set
+    own = collect()
+    workers = [(os.getpid(), True, own)]
+    if directory:
+        flush(directory)
+        workers += _other_workers(directory)
+    lines = []
+    for metric in REGISTRY:
+        total = {}
+        for pid, alive, series in workers:
+            values = series.get(metric.name, {})
+            if metric.kind == "gauge":
+                if not alive:
+                    continue
+                if directory:
+                    values = {(str(pid),): v for v in values.values()}
+            metric.merge(total, values)
+        lines.extend(metric.render(total))
+    return "\n".join(lines) + "\n"
+
+
+request_seconds = register(
+    Histogram(
+        "provenance_request_seconds",
+        "Time to build, run and parse one query",
+        ("engine", "mode", "action", "status"),
+    )
+)
+stage_seconds = register(
+    Histogram(
+        "provenance_stage_seconds",
+        "Time spent in one stage of a query",
+        ("stage", "engine", "mode"),
+    )
+)
+stage_bytes = register(
+    Counter(
+        "provenance_stage_bytes_total",
+        "Bytes read from engines or produced by a stage",
+        ("stage", "engine", "mode"),
+    )
+)
+stage_rows = register(
+    Counter(
+        "provenance_stage_rows_total",
+        "Rows produced by a stage",
+        ("stage", "engine", "mode"),
+    )
+)
+
+
+class Span:
+    __slots__ = ("name", "start", "duration", "bytes", "rows")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.duration = 0.0
+        self.bytes = None
+        self.rows = None
+
+
+class Trace:
+    # Spans of one request, kept in a context variable while it runs so
+    # code further down (prov_graph, graph_images) can add its own
+
+    def __init__(self, engine, mode, action=""):
+        self.engine = engine
+        self.mode = mode
+        self.action = action
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def timings(self):
+        return [
+            {
+                "stage": s.name,
+                "start_ms": round((s.start - self.start) * 1000, 2),
+                "ms": round(s.duration * 1000, 2),
+                "bytes": s.bytes,
+                "rows": s.rows,
+            }
+            for s in self.spans
+        ]
+
+
+_current = contextvars.ContextVar("provenance_trace", default=None)
+
+
+@contextmanager
+def trace(engine, mode, action=""):
+    t = Trace(engine, mode, action)
+    token = _current.set(t)
+    try:
+        yield t
+    finally:
+        _current.reset(token)
+
+
+def record(span, engine, mode):
+    stage_seconds.observe(span.duration, span.name, engine, mode)
+    if span.bytes:
+        stage_bytes.inc(span.bytes, span.name, engine, mode)
+    if span.rows:
+        stage_rows.inc(span.rows, span.name, engine, mode)
+
+
+@contextmanager
+def span(name, engine=None, mode=None):
+    # Times a stage of the current request. Set .bytes / .rows on the
+    # yielded span to record sizes. Outside a request, pass engine and mode.
+    t = _current.get()
+    s = Span(name, time.perf_counter())
+    try:
+        yield s
+    finally:
+        s.duration = time.perf_counter() - s.start
+        if t is not None:
+            t.spans.append(s)
+            engine = engine or t.engine
+            mode = mode or t.mode
+        record(s, engine or "", mode or "")
+
+
+def count_bytes(lines, s):
+    # Passes lines through, adding their size to span `s`
+    s.bytes = s.bytes or 0
+    for line in lines:
+        s.bytes += len(line)
+        yield line
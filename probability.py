@@ -0,0 +1,264 @@
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from circuits import circuits, uuid_array
+from metrics import span
+from result_cache import ResultCache
+
+
+# Parallel evaluation (override with environment variables)
+PROB_PARALLELISM = int(os.environ.get("PROB_PARALLELISM", "4"))
+PROB_BATCH = int(os.environ.get("PROB_BATCH", "200"))
+# Probabilities memoized per (method, token)
+PROB_MEMO_ENTRIES = int(os.environ.get("PROB_MEMO_ENTRIES", "100000"))
+PROB_MEMO_TTL = float(os.environ.get("PROB_MEMO_TTL", "3600"))
+# Shared by the worker processes of server.py, so set_prob clears every memo
+PROB_MEMO_DIR = os.environ.get("PROB_MEMO_DIR", "")
+# Method selection: circuits sampled, gates walked per circuit, and the
+# largest number of inputs enumerated with possible-worlds
+PROB_SAMPLE = int(os.environ.get("PROB_SAMPLE", "20"))
+PROB_SIZE_LIMIT = int(os.environ.get("PROB_SIZE_LIMIT", "2000"))
+PROB_WORLDS_MAX = int(os.environ.get("PROB_WORLDS_MAX", "10"))
+
+AUTO = "auto"
+POSSIBLE_WORLDS = "'possible-worlds'"
+TOKEN_COLUMN = "provsql_token"
+RESULT_COLUMN = "probability_evaluate"
+
+# Statements that change input probabilities, and so every memoized value
+SET_PROB_RE = re.compile(r"\bset_prob\s*\(", re.IGNORECASE)
+
+
+def is_cancellation(error, job=None) -> bool:
+    # The job was cancelled or timed out, or the backend cancelled the query
+    if job is not None and job.cancel_reason is not None:
+        return True
+    return type(error).__name__ in ("QueryCanceledError", "QueryCanceled")
+
+
+def memo_key(method: str, token) -> str:
+    # Hashed, the key is a file name when the memo has a directory
+    return hashlib.sha256(f"{method}\x1f{token}".encode("utf-8")).hexdigest()
+
+
+def is_auto(method: str) -> bool:
+    return method.strip().strip("'").lower() in ("", AUTO)
+
+
+def token_query(subquery: str) -> str:
+    return f"SELECT *, provenance()::text AS {TOKEN_COLUMN} FROM ({subquery}) t;"
+
+
+def batch_query(method: str, ids: str) -> str:
+    # No method is ProvSQL's default, exact evaluation
+    args = f", {method}" if method else ""
+    return (
+        f"SELECT t::text, probability_evaluate(t{args}) "
+        f"FROM unnest(ARRAY[{ids}]::uuid[]) AS t;"
+    )
+
+
+def parallel_query(subquery: str, method: str) -> str:
+    # What runs, shown on the page and used as the result cache key
+    method = "<auto>" if is_auto(method) else method
+    return (
+        token_query(subquery)
+        + f"\n-- then per batch of up to {PROB_BATCH} tokens, in parallel:\n"
+        + batch_query(method, "...")
+    )
+
+
+def circuit_shape(token, limit=PROB_SIZE_LIMIT):
+    # (inputs, shared) of a token's circuit, read through the circuit
+    # cache. shared is True when some gate is reached twice. None when the
+    # circuit has more than `limit` gates.
+    seen = set()
+    inputs = 0
+    shared = False
+    frontier = [token]
+    while frontier:
+        if len(seen) + len(frontier) > limit:
+            return None
+        gates = circuits.gates(frontier)
+        # The whole level first, a child may also sit on this level
+        seen.update(frontier)
+        next_level = []
+        queued = set()
+        for uid in frontier:
+            kind, children, _, _ = gates.get(uid, ("input", (), None, None))
+            if kind == "input":
+                inputs += 1
+            for child in children:
+                if child in seen or child in queued:
+                    shared = True
+                else:
+                    queued.add(child)
+                    next_level.append(child)
+        frontier = next_level
+    return inputs, shared
+
+
+def prefetch(tokens, limit=PROB_SIZE_LIMIT):
+    # Reads the circuits of several tokens into the circuit cache together,
+    # one query per level, stopping past `limit` gates
+    seen = set()
+    frontier = list(dict.fromkeys(tokens))
+    while frontier and len(seen) + len(frontier) <= limit:
+        gates = circuits.gates(frontier)
+        seen.update(frontier)
+        next_level = []
+        for uid in frontier:
+            for child in gates.get(uid, ("input", (), None, None))[1]:
+                if child not in seen:
+                    seen.add(child)
+                    next_level.append(child)
+        frontier = next_level
+
+
+def enumerable(tokens):
+    # Tokens whose circuits have few enough inputs for possible-worlds
+    prefetch(tokens)
+    small = set()
+    for token in tokens:
+        shape = circuit_shape(token)
+        if shape is not None and shape[0] <= PROB_WORLDS_MAX:
+            small.add(token)
+    return small
+
+
+def choose_method(tokens, sample=PROB_SAMPLE):
+    # Cheapest method that suits a sample of the circuits. Batches where it
+    # fails are evaluated again with the exact default. possible-worlds is
+    # checked again per token, see ProbabilityEngine._evaluate_batch.
+    if not tokens:
+        return ""
+    step = max(len(tokens) // sample, 1)
+    with span("prob_select") as s:
+        shapes = [circuit_shape(t) for t in tokens[::step][:sample]]
+        s.rows = len(shapes)
+    if any(shape is None for shape in shapes):
+        return ""
+    if not any(shared for _, shared in shapes):
+        return "'independent'"
+    if max(inputs for inputs, _ in shapes) <= PROB_WORLDS_MAX:
+        return POSSIBLE_WORLDS
+    return ""
+
+
+class ProbabilityEngine:
+    # Evaluates probability_evaluate per provenance token instead of per
+    # row: the rows and their tokens are read first, then the distinct
+    # tokens not memoized yet are evaluated in batches over several pooled
+    # connections at once.
+
+    def __init__(self, memo=None, parallelism=PROB_PARALLELISM, batch=PROB_BATCH):
+        self.memo = memo or ResultCache(
+            max_entries=PROB_MEMO_ENTRIES,
+            max_bytes=PROB_MEMO_ENTRIES * 256,
+            ttl=PROB_MEMO_TTL,
+            directory=PROB_MEMO_DIR or None,
+        )
+        self.parallelism = parallelism
+        self.batch = batch
+
+    def evaluate(self, pool, subquery, method, job=None):
+        # Returns (columns, rows, note), rows as the serial query would
+        # return them
+        method = "" if is_auto(method) else method.strip()
+        memo_method = method or AUTO
+        with span("engine") as s:
+            columns, rows, _ = pool.execute(token_query(subquery), job=job)
+            s.rows = len(rows)
+        index = columns.index(TOKEN_COLUMN)
+
+        probabilities = {}
+        missing = []
+        for row in rows:
+            token = row[index]
+            if token is None or token in probabilities:
+                continue
+            value = self.memo.get(memo_key(memo_method, token))
+            probabilities[token] = value
+            if value is None:
+                missing.append(token)
+
+        chosen = method if method else choose_method(missing)
+        batches = [missing[i : i + self.batch] for i in range(0, len(missing), self.batch)]
+        workers = max(min(self.parallelism, len(batches), pool.size), 1)
+        with span("probability") as s:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                evaluated = executor.map(
+                    lambda batch: self._evaluate_batch(
+                        pool, chosen, batch, job, fallback=not method
+                    ),
+                    batches,
+                )
+                for values in evaluated:
+                    probabilities.update(values)
+            s.rows = len(missing)
+        for token in missing:
+            if probabilities.get(token) is not None:
+                self.memo.put(memo_key(memo_method, token), probabilities[token])
+
+        out_columns = [c for i, c in enumerate(columns) if i != index] + [RESULT_COLUMN]
+        out_rows = [
+            [v for i, v in enumerate(row) if i != index] + [probabilities.get(row[index])]
+            for row in rows
+        ]
+        note = f"{len(probabilities)} distinct tokens"
+        if missing:
+            used = chosen or "exact evaluation"
+            if chosen == POSSIBLE_WORLDS and not method:
+                used += f" (circuits of up to {PROB_WORLDS_MAX} inputs, exact otherwise)"
+            note += (
+                f": {len(missing)} evaluated in {len(batches)} batches on "
+                f"{workers} connections with {used}"
+            )
+        note += f", {len(probabilities) - len(missing)} memoized"
+        return out_columns, out_rows, note
+
+    def _evaluate_batch(self, pool, method, batch, job, fallback=False):
+        if job is not None:
+            # Batches still queued when the job is cancelled do not start
+            job.check()
+        groups = [(method, batch)]
+        if method == POSSIBLE_WORLDS and fallback:
+            # Enumeration is exponential in the inputs and only the sample
+            # was checked: circuits not known to be small are evaluated
+            # exactly instead
+            small = enumerable(batch)
+            groups = [
+                (method, [t for t in batch if t in small]),
+                ("", [t for t in batch if t not in small]),
+            ]
+        values = {}
+        for group_method, tokens in groups:
+            if tokens:
+                values.update(
+                    self._run_batch(pool, group_method, tokens, job, fallback)
+                )
+        return values
+
+    def _run_batch(self, pool, method, batch, job, fallback):
+        ids = uuid_array(batch)
+        try:
+            _, rows, _ = pool.execute(batch_query(method, ids), job=job)
+        except Exception as e:
+            if not (method and fallback) or is_cancellation(e, job):
+                raise
+            # The selected method does not apply to some circuit of the batch
+            _, rows, _ = pool.execute(batch_query("", ids), job=job)
+        return {
+            str(token): None if value is None else float(value) for token, value in rows
+        }
+
+    def clear(self):
+        return self.memo.clear()
+
+    def stats(self):
+        return self.memo.stats()
+
+
+probabilities = ProbabilityEngine()
@@ -1,63 +1,281 @@
 import csv
-from graphviz import Digraph
-
-# Read ProvSQL CSV and build provenance structure
-provenance = {}
-
-with open("./static/prov_output.csv", newline="", encoding="utf-8-sig") as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        pos = row["position"]
-        formula = row["sr_formula"]
-
-        # Fix corrupted Γèò symbols (Excel sometimes breaks UTF-8 into "├ó┼áΓÇó")
-        formula = formula.replace("├ó┼áΓÇó", "Γèò")
-
-        # Parse contributors ΓÇö remove parentheses and split by Γèò
-        inputs = [
-            f.strip()
-            for f in formula.replace("(", "").replace(")", "").split("Γèò")
-            if f.strip()
-        ]
-        provenance[pos] = inputs
-
-# Initialize Graphviz graph
-dot = Digraph(comment="Provenance Graph")
-dot.attr(rankdir="TB", splines="spline", nodesep="0.6", ranksep="0.8")
-
-# Add input nodes (source tuples)
-all_inputs = set(inp for inputs in provenance.values() for inp in inputs)
-for inp in all_inputs:
-    dot.node(inp, inp, shape="box", style="filled", fillcolor="lightgray")
-
-# Add output nodes (derived tuples)
-for out in provenance:
-    dot.node(out, out, shape="ellipse", style="filled", fillcolor="lightblue")
-
-# Add Γèò operation nodes and edges
-for out, inputs in provenance.items():
-    if len(inputs) == 1:
-        # Single contributor ΓåÆ direct edge
-        dot.edge(inputs[0], out)
-    elif len(inputs) > 1:
-        plus_node = f"plus_{out}"
-        dot.node(
-            plus_node,
-            label="Γèò",
-            shape="circle",
-            style="filled",
-            fillcolor="white",
-            fontsize="18",
-            fontname="Segoe UI Symbol",
-            fixedsize="false",  # auto-size
+import sys
+from collections import defaultdict
+
+from metrics import span
+from sr_formula import LEAF, PLUS, FormulaDAG
+
+FORMULA_COLUMN = "sr_formula"
+# ProvSQL's token column, not part of the tuple label
+TOKEN_COLUMN = "provsql"
+
+# Bounds for drawing large lineages (see ProvenanceGraph.view)
+TOP_K = 50
+MAX_INPUTS = 25
+COLLAPSE_ABOVE = 150
+
+# Ids of the placeholder nodes, clicking them expands the view
+MORE_OUTPUTS = "more-outputs:"
+MORE_INPUTS_PREFIX = "more:"
+GROUP_PREFIX = "group:"
+# Clickable nodes carry their key as SVG id, prefixed (see index.html).
+# Graphviz names are synthetic: "a:b" in an edge would be read as a port.
+NODE_ID_PREFIX = "prov-"
+
+
+def load_provenance(columns, rows, dag=None):
+    # Parse each row's formula into one shared DAG. Returns (dag, roots),
+    # roots maps each output tuple (label built from its non-formula
+    # columns) to its formula node. rows are sequences matching `columns`.
+    columns = [str(c) for c in columns]
+    formula_idx = columns.index(FORMULA_COLUMN)
+    label_idx = [
+        i for i, c in enumerate(columns) if i != formula_idx and c != TOKEN_COLUMN
+    ]
+    dag = dag if dag is not None else FormulaDAG()
+    roots = {}
+    with span("graph_parse") as s:
+        for row in rows:
+            out = ", ".join(str(row[i]) for i in label_idx)
+            roots[out] = dag.parse(str(row[formula_idx] or ""))
+        s.rows = len(roots)
+    return dag, roots
+
+
+def relation_of(token: str):
+    # Relation an input tuple comes from, when the provenance mapping encodes
+    # it as "relation:value" or "relation.value". None means no cluster.
+    for sep in (":", "."):
+        rel, found, rest = token.partition(sep)
+        if found and rel and rest and rel.isidentifier():
+            return rel
+    return None
+
+
+class ProvenanceGraph:
+    # Output → inputs (read from the formula DAG) plus the reverse index,
+    # used to draw a bounded view of large lineages: the top-k outputs by
+    # fan-in, capped inputs per output, inputs with identical neighbourhoods
+    # collapsed into one node, and clusters per relation. Nodes listed in
+    # `expand` show their whole neighbourhood.
+
+    def __init__(self, dag, roots, relation=relation_of):
+        self.dag = dag
+        self.roots = roots
+        with span("graph_index"):
+            self.inputs_of = {out: dag.leaves(root) for out, root in roots.items()}
+            self.outputs_of = defaultdict(list)
+            for out, inputs in self.inputs_of.items():
+                for inp in inputs:
+                    self.outputs_of[inp].append(out)
+        self.relation = relation
+        # Outputs by fan-in, largest first
+        self.ranked = sorted(self.inputs_of, key=lambda o: -len(self.inputs_of[o]))
+
+    def render(self, format="svg", **view) -> bytes:
+        # Layout runs in Graphviz's dot through a pipe, no files are written
+        with span("graph_view"):
+            dot = self.view(**view)
+        with span("graph_layout") as s:
+            image = dot.pipe(format=format)
+            s.bytes = len(image)
+        return image
+
+    def size(self):
+        return len(self.inputs_of) + len(self.outputs_of)
+
+    def view(
+        self,
+        top_k=TOP_K,
+        max_inputs=MAX_INPUTS,
+        expand=(),
+        collapse_above=COLLAPSE_ABOVE,
+    ):
+        expand = set(expand)
+
+        # --- Pick outputs: top-k plus the neighbourhood of expanded inputs ---
+        outputs = list(self.ranked[:top_k])
+        shown = set(outputs)
+        for node in expand:
+            if node.startswith(GROUP_PREFIX):
+                # Expanding a group only splits it, see below
+                continue
+            for out in self.outputs_of.get(node, ()):
+                if out not in shown:
+                    shown.add(out)
+                    outputs.append(out)
+        hidden_outputs = len(self.inputs_of) - len(outputs)
+
+        # --- Pick inputs per output, capped unless the output is expanded ---
+        edges = {}
+        hidden_inputs = {}
+        for out in outputs:
+            inputs = self.inputs_of[out]
+            if (
+                out in expand
+                or MORE_INPUTS_PREFIX + out in expand
+                or len(inputs) <= max_inputs
+            ):
+                edges[out] = inputs
+            else:
+                edges[out] = inputs[:max_inputs]
+                hidden_inputs[out] = len(inputs) - max_inputs
+
+        # --- Collapse inputs that feed exactly the same shown outputs ---
+        targets = defaultdict(list)
+        for out, inputs in edges.items():
+            for inp in inputs:
+                targets[inp].append(out)
+        node_of = {inp: inp for inp in targets}
+        groups = {}
+        if len(targets) + len(outputs) > collapse_above:
+            by_targets = defaultdict(list)
+            for inp, outs in targets.items():
+                if inp not in expand:
+                    by_targets[tuple(sorted(outs))].append(inp)
+            for members in by_targets.values():
+                if len(members) > 1:
+                    members.sort()
+                    group_id = GROUP_PREFIX + members[0]
+                    if group_id in expand:
+                        continue
+                    groups[group_id] = members
+                    for m in members:
+                        node_of[m] = group_id
+
+        return self._draw(
+            outputs, edges, node_of, groups, hidden_inputs, hidden_outputs
         )
 
-        # Connect inputs to Γèò node, then to output
-        for inp in inputs:
-            dot.edge(inp, plus_node)
-        dot.edge(plus_node, out)
+    def _draw(self, outputs, edges, node_of, groups, hidden_inputs, hidden_outputs):
+        # Imported here so the web app only pays for graphviz when drawing
+        from graphviz import Digraph
+
+        dot = Digraph(comment="Provenance Graph")
+        dot.attr(rankdir="TB", splines="spline", nodesep="0.6", ranksep="0.8")
+        names = {}
+
+        def name(key):
+            if key not in names:
+                names[key] = f"n{len(names)}"
+            return names[key]
+
+        # Add input nodes (source tuples), clustered by relation
+        clusters = defaultdict(list)
+        for inp in sorted(set(node_of.values())):
+            if inp in groups:
+                members = groups[inp]
+                rel = self.relation(members[0])
+                if any(self.relation(m) != rel for m in members):
+                    rel = None
+                clusters[rel].append(
+                    (inp, f"{len(members)} tuples", "\n".join(members[:20]))
+                )
+            else:
+                clusters[self.relation(inp)].append((inp, inp, inp))
+        for rel, nodes in clusters.items():
+            graph = dot
+            if rel is not None:
+                graph = Digraph(name=f"cluster_{rel}")
+                graph.attr(label=rel, style="rounded", color="gray")
+            for node_id, label, tooltip in nodes:
+                graph.node(
+                    name(node_id),
+                    label,
+                    id=NODE_ID_PREFIX + node_id,
+                    tooltip=tooltip,
+                    shape="box3d" if node_id in groups else "box",
+                    style="filled",
+                    fillcolor="lightgray",
+                )
+            if rel is not None:
+                dot.subgraph(graph)
+
+        # Add output nodes (derived tuples)
+        for out in outputs:
+            dot.node(
+                name(out),
+                out,
+                id=NODE_ID_PREFIX + out,
+                shape="ellipse",
+                style="filled",
+                fillcolor="lightblue",
+            )
+
+        # Add operation nodes (the formula's top operator) and edges
+        dag = self.dag
+        for out in outputs:
+            sources = []
+            for inp in edges[out]:
+                if node_of[inp] not in sources:
+                    sources.append(node_of[inp])
+            if out in hidden_inputs:
+                more = MORE_INPUTS_PREFIX + out
+                dot.node(
+                    name(more),
+                    f"+{hidden_inputs[out]} more",
+                    id=NODE_ID_PREFIX + more,
+                    shape="note",
+                    style="dashed",
+                )
+                sources.append(more)
+            root = self.roots[out]
+            if len(sources) == 1 and dag.kind(root) == LEAF:
+                # Single contributor → direct edge
+                dot.edge(name(sources[0]), name(out))
+            elif sources:
+                plus_node = name(("plus", out))
+                dot.node(
+                    plus_node,
+                    label=dag.symbol(root) or PLUS,
+                    tooltip=dag.to_string(root, limit=500),
+                    shape="circle",
+                    style="filled",
+                    fillcolor="white",
+                    fontsize="18",
+                    fontname="Segoe UI Symbol",
+                    fixedsize="false",  # auto-size
+                )
+
+                # Connect inputs to ⊕ node, then to output
+                for src in sources:
+                    dot.edge(name(src), plus_node)
+                dot.edge(plus_node, name(out))
+
+        if hidden_outputs > 0:
+            dot.node(
+                name(MORE_OUTPUTS),
+                f"+{hidden_outputs} more outputs",
+                id=NODE_ID_PREFIX + MORE_OUTPUTS,
+                shape="note",
+                style="dashed",
+            )
+
+        return dot
+
+
+def build_graph(dag, roots, **view):
+    return ProvenanceGraph(dag, roots).view(**view)
+
+
+def to_dot(columns, rows, **view) -> str:
+    return build_graph(*load_provenance(columns, rows), **view).source
+
+
+def render(columns, rows, format="svg", **view) -> bytes:
+    return ProvenanceGraph(*load_provenance(columns, rows)).render(format, **view)
+
+
+if __name__ == "__main__":
+    # Standalone use: ProvSQL CSV export → PNG
+    path = sys.argv[1] if len(sys.argv) > 1 else "./static/prov_output.csv"
+    with open(path, newline="", encoding="utf-8-sig") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        dag, roots = load_provenance(header, reader)
 
-# Render and view the graph
-dot.render("./static/prov_graph_plus", view=False, format="png", cleanup=True)
-print("Γ£à Provenance entries loaded:", len(provenance))
-print("Γ£à Graph generated as prov_graph_plus.png")
+    dot = build_graph(dag, roots)
+    dot.render("./static/prov_graph_plus", view=False, format="png", cleanup=True)
+    print("✅ Provenance entries loaded:", len(roots))
+    print("✅ Distinct subterms:", len(dag))
+    print("✅ Graph generated as prov_graph_plus.png")
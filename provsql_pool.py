@@ -0,0 +1,339 @@
+import os
+import queue
+import subprocess
+import threading
+import uuid
+from contextlib import contextmanager
+
+from result_cache import is_read_only
+from streaming import StreamingTable, TypedCsvTable, iter_process_lines
+
+# psycopg2 is imported on first use, see driver()
+psycopg2 = None
+_driver_missing = False
+
+
+# Connection settings (override with environment variables)
+PROVSQL_DSN = os.environ.get(
+    "PROVSQL_DSN", "host=localhost port=5432 dbname=test user=test"
+)
+PROVSQL_SEARCH_PATH = os.environ.get(
+    "PROVSQL_SEARCH_PATH", "provsql_test, provsql, public"
+)
+PROVSQL_POOL_SIZE = int(os.environ.get("PROVSQL_POOL_SIZE", "4"))
+PROVSQL_POOL_TIMEOUT = float(os.environ.get("PROVSQL_POOL_TIMEOUT", "30"))
+
+# ProvSQL container of the docker backend (docker exec + psql)
+PROVSQL_CONTAINER = os.environ.get("PROVSQL_CONTAINER", "provsql-demo")
+PROVSQL_PSQL_USER = os.environ.get("PROVSQL_PSQL_USER", "test")
+PROVSQL_PSQL_DB = os.environ.get("PROVSQL_PSQL_DB", "test")
+
+# psql output format of the docker backend: "csv" (psql 12+, quoted and
+# machine-readable) or "aligned" (the pretty-printed table)
+PSQL_OUTPUT = os.environ.get("PSQL_OUTPUT", "csv")
+
+# Session settings applied once when a connection is opened
+PROVSQL_SETTINGS = {
+    "provsql.where_provenance": "on",
+}
+
+
+def driver():
+    # The driver is optional (app.py falls back to docker exec + psql) and
+    # only imported when a connection is first needed
+    global psycopg2, _driver_missing
+    if psycopg2 is None and not _driver_missing:
+        try:
+            import psycopg2 as module
+        except ImportError:
+            _driver_missing = True
+            return None
+        psycopg2 = module
+    return psycopg2
+
+
+class ProvSQLPool:
+    # Keeps up to `size` warm connections to the ProvSQL database.
+    # `connect` can be swapped for any DB-API connect function (e.g. a local
+    # Postgres stand-in in tests), it is called as connect(dsn).
+
+    def __init__(
+        self,
+        dsn=PROVSQL_DSN,
+        size=PROVSQL_POOL_SIZE,
+        search_path=PROVSQL_SEARCH_PATH,
+        settings=None,
+        connect=None,
+        timeout=PROVSQL_POOL_TIMEOUT,
+    ):
+        if connect is None:
+            if driver() is None:
+                raise RuntimeError("psycopg2 is not installed")
+            connect = psycopg2.connect
+        self.dsn = dsn
+        self.size = size
+        self.search_path = search_path
+        self.settings = dict(PROVSQL_SETTINGS if settings is None else settings)
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = self._connect(self.dsn)
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            # search_path and provsql settings are set once per connection
+            if self.search_path:
+                cur.execute(
+                    "SELECT set_config('search_path', %s, false)", (self.search_path,)
+                )
+            for name, value in self.settings.items():
+                cur.execute("SELECT set_config(%s, %s, false)", (name, value))
+        finally:
+            cur.close()
+        return conn
+
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if not can_open:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise RuntimeError(
+                        f"No free ProvSQL connection within {self.timeout:g}s"
+                    ) from None
+            else:
+                try:
+                    return self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+
+        if getattr(conn, "closed", False):
+            # Server closed it while idle, replace it
+            self._discard(conn)
+            with self._lock:
+                self._opened += 1
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._opened -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            # Query errors leave an autocommit connection usable, connection
+            # level errors do not
+            broken = psycopg2 is not None and isinstance(
+                e, (psycopg2.OperationalError, psycopg2.InterfaceError)
+            )
+            raise
+        finally:
+            if broken or getattr(conn, "closed", False):
+                self._discard(conn)
+            else:
+                self._idle.put(conn)
+
+    def execute(self, sql, params=None, job=None):
+        # Returns (columns, rows, status). Rows keep the driver's Python types.
+        # A running query is cancelled at the backend when `job` is cancelled.
+        with self.connection() as conn:
+            remove = self._cancel_hook(conn, job)
+            cur = conn.cursor()
+            try:
+                cur.execute(sql, params)
+                status = getattr(cur, "statusmessage", "") or ""
+                if cur.description is None:
+                    return [], [], status
+                columns = [d[0] for d in cur.description]
+                rows = [list(r) for r in cur.fetchall()]
+                return columns, rows, status
+            finally:
+                cur.close()
+                remove()
+
+    def stream(self, sql, itersize=2000, job=None):
+        # Returns (columns, rows) where rows is a generator reading from a
+        # server-side cursor `itersize` rows at a time. The connection stays
+        # checked out until the generator is exhausted or closed.
+        rows = self._iter_rows(sql, itersize, job)
+        columns = next(rows)
+        return columns, rows
+
+    def _iter_rows(self, sql, itersize, job):
+        with self.connection() as conn:
+            remove = self._cancel_hook(conn, job)
+            try:
+                # WITH HOLD so the cursor survives autocommit
+                cur = conn.cursor(name="provsql_" + uuid.uuid4().hex, withhold=True)
+                cur.itersize = itersize
+                try:
+                    cur.execute(sql)
+                    first = cur.fetchmany(itersize)
+                    yield [d[0] for d in cur.description]
+                    while first:
+                        for r in first:
+                            yield list(r)
+                        first = cur.fetchmany(itersize)
+                finally:
+                    cur.close()
+            finally:
+                remove()
+
+    @staticmethod
+    def _cancel_hook(conn, job):
+        # The hook only cancels this job's query, it is removed before the
+        # connection goes back to the pool. Returns the remover.
+        if job is None:
+            return lambda: None
+        remove = job.on_cancel(conn.cancel)
+        try:
+            # A cancel that came before the hook would not stop the query
+            job.check()
+        except Exception:
+            remove()
+            raise
+        return remove
+
+    def warm(self):
+        # Opens every connection now rather than on the first queries
+        opened = []
+        try:
+            for _ in range(self.size):
+                opened.append(self._acquire())
+        finally:
+            for conn in opened:
+                self._idle.put(conn)
+        return len(opened)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_provsql_pool():
+    # Shared pool for the app, None when the driver is missing or the docker
+    # backend was requested explicitly (PROVSQL_BACKEND=docker)
+    global _pool
+    if os.environ.get("PROVSQL_BACKEND", "pool") == "docker" or driver() is None:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProvSQLPool()
+        return _pool
+
+
+def psql_options(search_path=PROVSQL_SEARCH_PATH, settings=None):
+    # PGOPTIONS giving psql sessions the search_path and provsql settings
+    # the pool sets on its connections. Spaces separate options there.
+    settings = dict(PROVSQL_SETTINGS if settings is None else settings)
+    if search_path:
+        settings["search_path"] = ",".join(
+            p.strip() for p in search_path.split(",") if p.strip()
+        )
+    return " ".join(
+        f"-c {name}={str(value).replace(' ', '')}" for name, value in settings.items()
+    )
+
+
+def psql_command(sql, output=PSQL_OUTPUT, application_name=None):
+    # psql inside the ProvSQL demo container (docker backend), with the
+    # pool's session settings. application_name tags the backend so
+    # cancel_backend can find it.
+    command = ["docker", "exec", "-i", "-e", f"PGOPTIONS={psql_options()}"]
+    if application_name:
+        command += ["-e", f"PGAPPNAME={application_name}"]
+    command += [
+        PROVSQL_CONTAINER,
+        "psql",
+        "-U",
+        PROVSQL_PSQL_USER,
+        PROVSQL_PSQL_DB,
+    ]
+    if output == "csv":
+        command.append("--csv")
+    return command + ["-c", sql]
+
+
+def cancel_backend(application_name, timeout=10):
+    # Killing `docker exec` leaves psql and its query running in the
+    # container, so the backend query is cancelled by name
+    sql = (
+        "SELECT pg_cancel_backend(pid) FROM pg_stat_activity "
+        f"WHERE application_name = '{application_name}';"
+    )
+    try:
+        subprocess.run(psql_command(sql), capture_output=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+
+def run_query(full_query, job=None):
+    # Executor of the provsql engine (see engines.py). On the pool, reads
+    # come as (columns, rows) from a server-side cursor and other statements
+    # as (columns, rows, status). The docker backend returns psql's output
+    # lines, in PSQL_OUTPUT format. Cancelling `job` cancels the query.
+    pool = get_provsql_pool()
+    if pool is not None:
+        if is_read_only(full_query):
+            return pool.stream(full_query, job=job)
+        return pool.execute(full_query, job=job)
+    # Killing docker exec leaves the query running in the container, it is
+    # cancelled by name as well
+    app_name = "provenance_" + uuid.uuid4().hex[:12]
+    process = subprocess.Popen(
+        psql_command(full_query, application_name=app_name),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if job is not None:
+        job.on_cancel(process.kill)
+        job.on_cancel(lambda: cancel_backend(app_name))
+    return iter_process_lines(process)
+
+
+def psql_table(lines):
+    # Parser of the provsql engine's output lines
+    if PSQL_OUTPUT == "csv":
+        return TypedCsvTable(lines)
+    return StreamingTable(lines)
+
+
+def database_identity():
+    if get_provsql_pool() is not None:
+        return f"provsql:{PROVSQL_DSN}"
+    return f"provsql:docker:{PROVSQL_CONTAINER}/{PROVSQL_PSQL_DB}"
@@ -0,0 +1,94 @@
+# Query templates per engine and mode. `fields` is the dict built by
+# app.read_form, the same for the query page, jobs and the batch API.
+
+
+def _attach_clause(query: str, clause: str, group_by_attrs: str) -> str:
+    # HAS/USE PROVENANCE goes after the FROM list of the query
+    upper_query = query.upper()
+    if "FROM" in upper_query:
+        from_idx = upper_query.index("FROM") + len("FROM")
+        before_from = query[:from_idx]
+        after_from = query[from_idx:].strip()
+        full_query = f"PROVENANCE OF ({before_from} {after_from} {clause}"
+    else:
+        full_query = f"PROVENANCE OF ({query} {clause}"
+    if group_by_attrs:
+        full_query += f" GROUP BY {group_by_attrs}"
+    return full_query + ");"
+
+
+def build_gprom_query(fields: dict) -> str:
+    query = fields["query"]
+    mode = fields["mode"]
+    if mode == "provenance":
+        return f"PROVENANCE OF ({query});"
+    if mode == "timestamp" and fields["timestamp"]:
+        return f"PROVENANCE AS OF TIMESTAMP '{fields['timestamp']}' OF ({query});"
+    if (
+        mode == "baserelation"
+        and fields["main_select"]
+        and fields["subquery"]
+        and fields["baserelation"]
+    ):
+        return (
+            f"PROVENANCE OF ({fields['main_select']} ( {fields['subquery']} ) "
+            f"BASERELATION AS {fields['baserelation']});"
+        )
+    if mode == "has_provenance" and fields["has_attrs"]:
+        return _attach_clause(
+            query, f"HAS PROVENANCE ({fields['has_attrs']})", fields["group_by_attrs"]
+        )
+    if mode == "use_provenance" and fields["use_attrs"]:
+        return _attach_clause(
+            query, f"USE PROVENANCE ({fields['use_attrs']})", fields["group_by_attrs"]
+        )
+    if mode == "reenact":
+        return f"REENACT ({query});"
+    if mode == "reenact_provenance":
+        return f"REENACT WITH PROVENANCE ({query});"
+    if mode == "reenact_annotations":
+        return f"REENACT WITH PROVENANCE ONLY UPDATED SHOW INTERMEDIATE STATEMENT ANNOTATIONS ({query});"
+    return query.rstrip(";") + ";"
+
+
+def build_provsql_query(fields: dict) -> str:
+    # Missing inputs give an SQL comment explaining what is missing, which
+    # is shown instead of running anything
+    query = fields["query"]
+    mode = fields["mode"]
+    if mode == "default":
+        return query.rstrip(";") + ";"
+    if mode == "add_provenance":
+        return f"SELECT add_provenance({query});"
+    if mode == "create_provenance_mapping":
+        return f"SELECT create_provenance_mapping({query});"
+    if mode == "semirings":
+        if fields["semirings_table"] and fields["semirings_subquery"]:
+            return (
+                f"SELECT *, SR_FORMULA(PROVENANCE(), {fields['semirings_table']}) "
+                f"FROM ({fields['semirings_subquery']}) t;"
+            )
+        return "-- Missing table or subquery for semirings"
+    if mode == "where_provenance":
+        if fields["wp_subquery"]:
+            return f"SELECT *, where_provenance(provenance()) FROM ({fields['wp_subquery']}) t;"
+        return "-- Missing subquery for WHERE_PROVENANCE"
+    if mode == "probability":
+        if fields["prob_method"] and fields["prob_subquery"]:
+            method = fields["prob_method"]
+            # auto leaves the choice to ProvSQL (exact evaluation)
+            args = "" if method.strip("'").lower() == "auto" else f", {method}"
+            return (
+                f"SELECT *, probability_evaluate(provenance(){args}) "
+                f"FROM ({fields['prob_subquery']}) t;"
+            )
+        return "-- Missing method or subquery for PROBABILITY"
+    return ""
+
+
+def build_query(fields: dict) -> str:
+    if fields["engine"] == "gprom":
+        return build_gprom_query(fields)
+    if fields["engine"] == "provsql":
+        return build_provsql_query(fields)
+    return ""
@@ -0,0 +1,115 @@
+import hashlib
+import os
+
+from result_cache import ResultCache, referenced_tables
+
+
+# Results of re-enacted histories (override with environment variables)
+CHECKPOINT_MAX_ENTRIES = int(os.environ.get("REENACT_CHECKPOINTS", "64"))
+CHECKPOINT_MAX_BYTES = int(
+    os.environ.get("REENACT_CHECKPOINT_BYTES", str(128 * 1024 * 1024))
+)
+CHECKPOINT_TTL = float(os.environ.get("REENACT_CHECKPOINT_TTL", "3600"))
+CHECKPOINT_DIR = os.environ.get("REENACT_CHECKPOINT_DIR", "")
+
+# REENACT options per mode, see queries.build_gprom_query
+REENACT_OPTIONS = {
+    "reenact": "",
+    "reenact_provenance": "WITH PROVENANCE",
+    "reenact_annotations": "WITH PROVENANCE ONLY UPDATED SHOW INTERMEDIATE STATEMENT ANNOTATIONS",
+}
+
+
+def split_statements(text: str):
+    # Statements of a transaction history, split on ";" outside quotes
+    statements = []
+    current = []
+    quote = None
+    for ch in text:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == ";":
+            stmt = "".join(current).strip()
+            if stmt:
+                statements.append(stmt)
+            current = []
+            continue
+        current.append(ch)
+    stmt = "".join(current).strip()
+    if stmt:
+        statements.append(stmt)
+    return statements
+
+
+def history_key(database: str, mode: str, statements) -> str:
+    # The database, the mode and every statement, whitespace-normalised
+    digest = hashlib.sha256(f"{database}\x1f{mode}".encode("utf-8"))
+    for stmt in statements:
+        digest.update(b"\x1e" + " ".join(stmt.split()).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Plan:
+    # One run of a history. `hit` is the stored result of the same history,
+    # None when it has to be re-enacted.
+
+    def __init__(self, mode, statements, key):
+        self.mode = mode
+        self.statements = statements
+        self.key = key
+        self.hit = None
+
+    def describe(self):
+        n = len(self.statements)
+        if self.hit is not None:
+            return f"All {n} statements restored from an earlier run of this history"
+        return f"Re-enacted all {n} statements"
+
+
+class ReenactSessions:
+    # Results of re-enacted transaction histories, reused when exactly the
+    # same history is re-enacted again. A history is always re-enacted in
+    # full: GProM cannot start from a stored result, and re-enacting only
+    # new statements would drop the lineage of the earlier ones. The
+    # results live in a size-bounded LRU (result_cache.ResultCache).
+
+    def __init__(self, store=None):
+        self.store = store or ResultCache(
+            max_entries=CHECKPOINT_MAX_ENTRIES,
+            max_bytes=CHECKPOINT_MAX_BYTES,
+            ttl=CHECKPOINT_TTL,
+            directory=CHECKPOINT_DIR or None,
+        )
+
+    def plan(self, database: str, mode: str, history: str):
+        statements = split_statements(history)
+        plan = Plan(mode, statements, history_key(database, mode, statements))
+        if statements:
+            plan.hit = self.store.get(plan.key)
+        return plan
+
+    def save(self, plan: Plan, columns, rows, text):
+        # Re-enactment reads the current data, so the result follows writes
+        # to the tables the statements touch
+        if not plan.statements:
+            return
+        tables = set()
+        for stmt in plan.statements:
+            tables.update(referenced_tables(stmt))
+        value = {"columns": columns, "rows": rows, "text": text}
+        self.store.put(plan.key, value, tables=tables)
+
+    def invalidate_table(self, table):
+        self.store.invalidate_table(table)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return self.store.stats()
+
+
+sessions = ReenactSessions()
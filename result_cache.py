@@ -0,0 +1,343 @@
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+# Cache settings (override with environment variables)
+CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "256"))
+CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "300"))
+CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+
+# Directories shared by worker processes are trimmed to their limits at most
+# every TRIM_INTERVAL seconds, or after a tenth of their entries was written
+TRIM_INTERVAL = 30
+
+# Modes that change the database and must never be served from the cache
+WRITE_MODES = {"add_provenance", "create_provenance_mapping"}
+
+# Tables referenced by a query, used for invalidation by table
+TABLE_RE = re.compile(
+    r"\b(?:FROM|JOIN|UPDATE|INTO|TABLE)\s+([A-Za-z_][\w.]*)", re.IGNORECASE
+)
+READ_RE = re.compile(r"^\s*\(?\s*(SELECT|WITH|VALUES)\b", re.IGNORECASE)
+# GProM statements that only compute provenance, whatever they wrap
+WRAPPED_RE = re.compile(r"^\s*(PROVENANCE|REENACT)\b", re.IGNORECASE)
+PINNED_RE = re.compile(r"\bPROVENANCE\s+AS\s+OF\s+TIMESTAMP\b", re.IGNORECASE)
+# ProvSQL functions that write, even when called from a SELECT
+WRITE_FUNCTION_RE = re.compile(
+    r"\b(set_prob|add_provenance|create_provenance_mapping)\s*\(", re.IGNORECASE
+)
+
+
+def referenced_tables(sql):
+    return {t.lower() for t in TABLE_RE.findall(sql)}
+
+
+def is_read_only(query):
+    # A plain SQL query that only reads
+    return bool(READ_RE.match(query)) and not WRITE_FUNCTION_RE.search(query)
+
+
+def is_cacheable(mode, query):
+    # Only read-only queries, judged on the query that was built: a mode
+    # missing its fields runs the raw query, which may carry any statement.
+    # GProM's wrappers (PROVENANCE OF, REENACT, ...) never write.
+    if mode in WRITE_MODES:
+        return False
+    if WRAPPED_RE.match(query):
+        return True
+    return is_read_only(query)
+
+
+def is_pinned(query):
+    # Provenance as of a fixed timestamp never changes
+    return bool(PINNED_RE.search(query))
+
+
+def trim_directory(directory, max_entries, max_bytes, suffix=".pkl"):
+    # Removes the least recently used files (by mtime) until at most
+    # `max_entries` files of at most `max_bytes` in total are left.
+    # Returns how many were removed.
+    files = []
+    try:
+        for entry in os.scandir(directory):
+            if entry.name.endswith(suffix):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return 0
+    files.sort(reverse=True)
+    removed = count = size = 0
+    for _, n, path in files:
+        count += 1
+        size += n
+        if count > max_entries or size > max_bytes:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+class DiskTrim:
+    # Decides when a shared directory is due for trim_directory
+
+    def __init__(self, max_entries, interval=TRIM_INTERVAL):
+        self.every = max(1, max_entries // 10)
+        self.interval = interval
+        self._writes = 0
+        self._next = time.monotonic() + interval
+
+    def due(self):
+        self._writes += 1
+        now = time.monotonic()
+        if self._writes < self.every and now < self._next:
+            return False
+        self._writes = 0
+        self._next = now + self.interval
+        return True
+
+
+def cache_key(engine, mode, full_query, database):
+    raw = "\x1f".join([engine, mode, full_query, database])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("value", "size", "expires", "tables")
+
+    def __init__(self, value, size, expires, tables):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.tables = tables
+
+
+class ResultCache:
+    # LRU cache bounded by entry count and by pickled size. Entries expire
+    # after `ttl` seconds unless stored with ttl=None (immutable results such
+    # as PROVENANCE AS OF TIMESTAMP). With `directory` set, entries are also
+    # written to disk. Several processes can share the directory: misses
+    # are looked up on disk, and entries whose file another process removed
+    # are dropped. Nothing is read at startup. The directory has its own
+    # limits (`disk_entries`, `disk_bytes`, the memory limits by default):
+    # files nobody used for longest are removed past them.
+
+    def __init__(
+        self,
+        max_entries=CACHE_MAX_ENTRIES,
+        max_bytes=CACHE_MAX_BYTES,
+        ttl=CACHE_TTL,
+        directory=CACHE_DIR or None,
+        disk_entries=None,
+        disk_bytes=None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_entries = max_entries if disk_entries is None else disk_entries
+        self.disk_bytes = max_bytes if disk_bytes is None else disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._trim = DiskTrim(self.disk_entries)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # --- Disk persistence ---
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def _read(self, key, value=True):
+        # (expires, tables, value, size) from the entry's file, the value is
+        # only unpickled when asked for. None when missing or unreadable.
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires, tables = pickle.load(f)
+                if not value:
+                    return expires, tables, None, 0
+                start = f.tell()
+                data = pickle.load(f)
+                return expires, tables, data, f.tell() - start
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._unlink(key)
+            return None
+
+    def _read_entry(self, key):
+        found = self._read(key)
+        if found is None:
+            return None
+        expires, tables, value, size = found
+        if expires is not None and expires <= time.time():
+            self._unlink(key)
+            return None
+        return _Entry(value, size, expires, tables)
+
+    def _keys_on_disk(self):
+        return [n[:-4] for n in os.listdir(self.directory) if n.endswith(".pkl")]
+
+    def _write(self, key, entry, data):
+        # Header (expires, tables) first, so invalidation can skip the value
+        tmp = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((entry.expires, entry.tables), f)
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        if self._trim.due():
+            trim_directory(self.directory, self.disk_entries, self.disk_bytes)
+
+    def _touch(self, key):
+        # Marks the file as used (trim_directory keeps recent ones), False
+        # when it is gone
+        try:
+            os.utime(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            return True
+
+    def _unlink(self, key):
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    # --- In-memory LRU ---
+    def _insert(self, key, entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            # The file stays for other processes, see trim_directory
+            _, e = self._entries.popitem(last=False)
+            self._bytes -= e.size
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+            self._unlink(key)
+        return entry is not None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.directory and not self._touch(key):
+                # Invalidated or trimmed by another process
+                self._entries.pop(key)
+                self._bytes -= entry.size
+                entry = None
+            if entry is None and self.directory:
+                # Stored by another process or an earlier run
+                entry = self._read_entry(key)
+                if entry is not None:
+                    self._insert(key, entry)
+                    self._touch(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires is not None and entry.expires <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key, value, tables=(), ttl=-1):
+        # ttl=-1 uses the cache default, ttl=None never expires
+        if ttl == -1:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        data = pickle.dumps(value)
+        if len(data) > self.max_bytes:
+            return False
+        entry = _Entry(value, len(data), expires, frozenset(tables))
+        with self._lock:
+            self._insert(key, entry)
+            if self.directory and key in self._entries:
+                self._write(key, entry, data)
+        return True
+
+    # --- Invalidation ---
+    def invalidate(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def invalidate_table(self, table):
+        table = table.lower()
+        with self._lock:
+            keys = [
+                k
+                for k, e in self._entries.items()
+                if table in e.tables or any(t.split(".")[-1] == table for t in e.tables)
+            ]
+            for k in keys:
+                self._remove(k)
+            if self.directory:
+                # Entries only other processes have loaded
+                for k in self._keys_on_disk():
+                    found = self._read(k, value=False)
+                    if found is not None and (
+                        table in found[1]
+                        or any(t.split(".")[-1] == table for t in found[1])
+                    ):
+                        self._unlink(k)
+                        keys.append(k)
+        return len(keys)
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            keys = [
+                k
+                for k, e in self._entries.items()
+                if e.expires is not None and e.expires <= now
+            ]
+            for k in keys:
+                self._remove(k)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            n = len(self._entries)
+            for k in list(self._entries):
+                self._remove(k)
+            if self.directory:
+                for k in self._keys_on_disk():
+                    self._unlink(k)
+                    n += 1
+        return n
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,402 @@
+import os
+import pickle
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from itertools import islice
+
+from result_cache import DiskTrim, trim_directory
+
+
+# Store settings
+MAX_RESULTS = 32
+MAX_CELLS = 50_000_000
+IDLE_TIMEOUT = 900
+FILL_CHUNK = 5000
+MAX_VIEWS = 8
+# Shared by the worker processes of server.py, unset keeps results in memory
+RESULT_STORE_DIR = os.environ.get("RESULT_STORE_DIR", "")
+# Limits of that directory, least recently paged results go first
+DISK_RESULTS = int(os.environ.get("RESULT_STORE_DISK_RESULTS", "256"))
+DISK_BYTES = int(os.environ.get("RESULT_STORE_DISK_BYTES", str(1024**3)))
+
+
+def sort_key(value):
+    # Numbers (and numeric strings from psql output) sort numerically and
+    # before text, NULLs go last
+    if value is None:
+        return (2, 0, "")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value, "")
+    if isinstance(value, str):
+        try:
+            return (0, float(value), "")
+        except ValueError:
+            return (1, 0, value)
+    try:
+        return (0, float(value), "")
+    except (TypeError, ValueError):
+        return (1, 0, str(value))
+
+
+class ColumnarResult:
+    # One list per column, string cells interned so repeated values (very
+    # common in provenance results) share one object. Integer and float
+    # columns are kept in typed array buffers (exported without copies, see
+    # to_arrow). Rows past the first page are pulled from `source`, see
+    # read_all; `close` releases whatever the source holds. At most about
+    # `max_cells` cells are read, `truncated` is set when rows of the source
+    # were dropped (cut off there, or the source was closed or failed).
+
+    def __init__(self, columns, rows=(), source=None, close=None, max_cells=None):
+        self.columns = list(columns)
+        self.max_rows = None
+        if max_cells is not None:
+            self.max_rows = max(max_cells // max(len(self.columns), 1), 1)
+        self.data = [[] for _ in self.columns]
+        self.length = 0
+        self.complete = source is None
+        self.truncated = False
+        self.last_used = time.monotonic()
+        self._source = source
+        self._close = close
+        self._views = OrderedDict()
+        self._lock = threading.RLock()
+        self.append_rows(rows)
+        self._type_columns()
+
+    def _type_columns(self):
+        # Columns whose first rows are all int (or all float) move to an
+        # array buffer, a later value that does not fit turns it back into
+        # a list (see append_rows)
+        for i, col in enumerate(self.data):
+            if not col:
+                continue
+            kinds = {type(v) for v in col}
+            try:
+                if kinds == {int}:
+                    self.data[i] = array("q", col)
+                elif kinds <= {int, float} and float in kinds:
+                    self.data[i] = array("d", col)
+            except OverflowError:
+                pass
+
+    def append_rows(self, rows):
+        data = self.data
+        width = len(data)
+        intern = sys.intern
+        for row in rows:
+            n = len(row)
+            for i in range(width):
+                v = row[i] if i < n else None
+                if type(v) is str:
+                    v = intern(v)
+                try:
+                    data[i].append(v)
+                except (TypeError, OverflowError):
+                    # Does not fit the column's typed buffer
+                    data[i] = list(data[i])
+                    data[i].append(v)
+            self.length += 1
+
+    def cells(self):
+        return self.length * len(self.columns)
+
+    def _fill(self, n=None):
+        # Make sure at least n rows (all rows when n is None) are loaded.
+        # Past `max_rows` the rest of the source is dropped.
+        while not self.complete and (n is None or self.length < n):
+            if self.max_rows is not None and self.length >= self.max_rows:
+                self._cut()
+                return
+            try:
+                chunk = list(islice(self._source, FILL_CHUNK))
+            except Exception:
+                self.close()
+                raise
+            self.append_rows(chunk)
+            if len(chunk) < FILL_CHUNK:
+                self.complete = True
+                self.close()
+
+    def _cut(self):
+        # Stops reading at max_rows, truncated if anything was left
+        try:
+            more = next(self._source, None) is not None
+        except Exception:
+            more = True
+        self.complete = True
+        self.close()
+        self.truncated = more
+
+    def read_all(self, progress=None):
+        # Reads the rest of the source and releases it, returns the length.
+        # The lock is taken one chunk at a time, so pages can be served from
+        # the rows read so far. progress, if given, is called with the row
+        # count after each chunk.
+        while True:
+            with self._lock:
+                if self.complete:
+                    return self.length
+                self._fill(self.length + 1)
+            if progress is not None:
+                progress(self.length)
+
+    def __getstate__(self):
+        # Pickled whole (see ResultStore with a directory), without the
+        # source or the cached views
+        with self._lock:
+            self._fill()
+            return {
+                "columns": self.columns,
+                "data": self.data,
+                "length": self.length,
+                "truncated": self.truncated,
+            }
+
+    def __setstate__(self, state):
+        self.__init__(state["columns"])
+        self.data = state["data"]
+        self.length = state["length"]
+        self.truncated = state.get("truncated", False)
+
+    def close(self):
+        # Releases the source. Rows not read by then are lost, the result
+        # ends at what was read and is marked truncated.
+        with self._lock:
+            if not self.complete:
+                self.complete = True
+                self.truncated = True
+            self._source = None
+            if self._close is not None:
+                self._close()
+                self._close = None
+
+    def row(self, i):
+        return [col[i] for col in self.data]
+
+    def all_rows(self):
+        # Every row, reading the rest of the source first
+        with self._lock:
+            self.last_used = time.monotonic()
+            self._fill()
+            return [self.row(i) for i in range(self.length)]
+
+    def iter_rows(self):
+        # Every row, one at a time, for exports
+        with self._lock:
+            self.last_used = time.monotonic()
+            self._fill()
+            length = self.length
+        for i in range(length):
+            yield self.row(i)
+
+    def to_arrow(self):
+        # pyarrow Table over the stored columns. Typed buffers are wrapped
+        # as they are, other columns are converted.
+        import pyarrow as pa
+
+        with self._lock:
+            self.last_used = time.monotonic()
+            self._fill()
+            arrays = []
+            for col in self.data:
+                if isinstance(col, array):
+                    kind = pa.int64() if col.typecode == "q" else pa.float64()
+                    arrays.append(
+                        pa.Array.from_buffers(kind, len(col), [None, pa.py_buffer(col)])
+                    )
+                else:
+                    try:
+                        arrays.append(pa.array(col))
+                    except (pa.ArrowInvalid, pa.ArrowTypeError):
+                        # Mixed types, export as text
+                        arrays.append(
+                            pa.array([None if v is None else str(v) for v in col])
+                        )
+        names = [str(c) for c in self.columns]
+        return pa.Table.from_arrays(arrays, names=names)
+
+    def column_values(self, col):
+        # One whole column, reading the rest of the source first
+        with self._lock:
+            self.last_used = time.monotonic()
+            self._fill()
+            return self.data[col]
+
+    def _view(self, sort, filters):
+        # Row order for a sort/filter combination, kept for later pages
+        key = (sort, filters)
+        order = self._views.get(key)
+        if order is not None:
+            self._views.move_to_end(key)
+            return order
+
+        order = range(self.length)
+        for col, text in filters:
+            column = self.data[col]
+            text = text.lower()
+            lowered = {}
+            kept = []
+            for i in order:
+                v = column[i]
+                s = lowered.get(v)
+                if s is None:
+                    s = lowered[v] = "" if v is None else str(v).lower()
+                if text in s:
+                    kept.append(i)
+            order = kept
+        if sort is not None:
+            col, desc = sort
+            keys = [sort_key(v) for v in self.data[col]]
+            order = sorted(order, key=keys.__getitem__, reverse=desc)
+        order = array("L", order)
+
+        self._views[key] = order
+        while len(self._views) > MAX_VIEWS:
+            self._views.popitem(last=False)
+        return order
+
+    def slice(self, offset, limit, sort=None, filters=()):
+        # Returns (rows, total). total is None while the unfiltered result
+        # is still being read from its source.
+        with self._lock:
+            self.last_used = time.monotonic()
+            if sort is None and not filters:
+                self._fill(offset + limit)
+                end = min(offset + limit, self.length)
+                rows = [self.row(i) for i in range(offset, end)]
+                return rows, self.length if self.complete else None
+            # Sorting and filtering need every row
+            self._fill()
+            order = self._view(sort, tuple(filters))
+            rows = [self.row(i) for i in order[offset : offset + limit]]
+            return rows, len(order)
+
+
+class ResultStore:
+    # Stored results by id, least recently used ones are dropped past
+    # `max_results` or `max_cells`, idle ones after `idle_timeout` seconds.
+    # With `directory` set, results are also written there once read in
+    # full, so any process sharing the directory can serve them; files are
+    # removed once idle for `idle_timeout`, or past `disk_results` files or
+    # `disk_bytes`.
+
+    def __init__(
+        self,
+        max_results=MAX_RESULTS,
+        max_cells=MAX_CELLS,
+        idle_timeout=IDLE_TIMEOUT,
+        directory=RESULT_STORE_DIR or None,
+        disk_results=DISK_RESULTS,
+        disk_bytes=DISK_BYTES,
+    ):
+        self.max_results = max_results
+        self.max_cells = max_cells
+        self.idle_timeout = idle_timeout
+        self.directory = directory
+        self.disk_results = disk_results
+        self.disk_bytes = disk_bytes
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._trim = DiskTrim(disk_results)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, result_id):
+        return os.path.join(self.directory, result_id + ".pkl")
+
+    def add(self, result, persist=True):
+        # persist=False keeps a result that is still being read out of the
+        # directory until persist() is called
+        result_id = uuid.uuid4().hex
+        if persist:
+            self.persist(result_id, result)
+        with self._lock:
+            self._results[result_id] = result
+            self._evict()
+        return result_id
+
+    def persist(self, result_id, result):
+        # Writes the result for the other processes, reading it to the end
+        if not self.directory:
+            return
+        data = pickle.dumps(result)
+        tmp = f"{self._path(result_id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(result_id))
+        self._prune()
+
+    def get(self, result_id):
+        with self._lock:
+            result = self._results.get(result_id)
+            if result is not None:
+                self._results.move_to_end(result_id)
+        if result is None and self.directory and result_id.isalnum():
+            # Stored by another process
+            try:
+                with open(self._path(result_id), "rb") as f:
+                    result = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                return None
+            with self._lock:
+                self._results[result_id] = result
+                self._evict()
+        if result is not None and self.directory:
+            try:
+                os.utime(self._path(result_id))
+            except OSError:
+                pass
+        return result
+
+    def __len__(self):
+        return len(self._results)
+
+    def remove(self, result_id):
+        # Takes a result out of the store, the caller closes it
+        if self.directory:
+            try:
+                os.remove(self._path(result_id))
+            except OSError:
+                pass
+        with self._lock:
+            return self._results.pop(result_id, None)
+
+    def _evict(self):
+        now = time.monotonic()
+        for k in [
+            k
+            for k, r in self._results.items()
+            if now - r.last_used > self.idle_timeout
+        ]:
+            self._results.pop(k).close()
+        while len(self._results) > self.max_results or (
+            len(self._results) > 1
+            and sum(r.cells() for r in self._results.values()) > self.max_cells
+        ):
+            _, r = self._results.popitem(last=False)
+            r.close()
+
+    def _prune(self):
+        # Files nobody read for `idle_timeout`, then the disk limits
+        if not self._trim.due():
+            return
+        cutoff = time.time() - self.idle_timeout
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".pkl") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        trim_directory(self.directory, self.disk_results, self.disk_bytes)
+
+    def sweep(self):
+        with self._lock:
+            self._evict()
+
+
+results = ResultStore()
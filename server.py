@@ -0,0 +1,141 @@
+import os
+import signal
+import socket
+import sys
+import tempfile
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # optional, workers are then forked here
+    BaseApplication = None
+
+
+# Production server: several worker processes on one port. Each worker has
+# its own connection and gprom pools; stored results, cached results, job
+# states, REENACT checkpoints, memoized probabilities, engine slots and
+# metrics are shared through SHARED_DIR.
+# Nothing else is written outside static/graphs (content addressed).
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "5000"))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", str(os.cpu_count() or 1)))
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", "8"))
+SERVER_TIMEOUT = int(os.environ.get("SERVER_TIMEOUT", "120"))
+SHARED_DIR = os.environ.get(
+    "SHARED_DIR", os.path.join(tempfile.gettempdir(), "provenance-shared")
+)
+
+# Settings pointed into SHARED_DIR unless set explicitly
+SHARED_SETTINGS = {
+    "RESULT_CACHE_DIR": "cache",
+    "RESULT_STORE_DIR": "results",
+    "JOB_DIR": "jobs",
+    "ENGINE_LOCK_DIR": "locks",
+    "REENACT_CHECKPOINT_DIR": "reenact",
+    "PROB_MEMO_DIR": "probabilities",
+    "METRICS_DIR": "metrics",
+}
+
+
+def configure(shared_dir=SHARED_DIR):
+    # Must run before app is imported, modules read these at import time.
+    # Workers open their engine connections as they start.
+    os.environ.setdefault("ENGINE_WARMUP", "gprom,provsql")
+    for name, sub in SHARED_SETTINGS.items():
+        path = os.environ.get(name) or os.path.join(shared_dir, sub)
+        os.environ[name] = path
+        os.makedirs(path, exist_ok=True)
+
+
+if BaseApplication is not None:
+
+    class GunicornServer(BaseApplication):
+        # gunicorn with threaded workers, app is imported in each worker
+
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+
+            return app
+
+
+def serve_gunicorn(host, port, workers):
+    GunicornServer(
+        {
+            "bind": f"{host}:{port}",
+            "workers": workers,
+            "worker_class": "gthread",
+            "threads": SERVER_THREADS,
+            "timeout": SERVER_TIMEOUT,
+        }
+    ).run()
+
+
+def run_worker(sock):
+    # Child process: its own app, serving from the shared listening socket
+    from werkzeug.serving import make_server
+
+    from app import app
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server.serve_forever()
+
+
+def serve_forked(host, port, workers):
+    # One listening socket, `workers` forked processes accepting on it.
+    # Workers that die are started again.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(*_):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"Serving on http://{host}:{port} with {workers} workers", flush=True)
+    while True:
+        pid, _ = os.wait()
+        if pid in children:
+            children.discard(pid)
+            spawn()
+
+
+def main():
+    configure()
+    if BaseApplication is not None:
+        serve_gunicorn(SERVER_HOST, SERVER_PORT, SERVER_WORKERS)
+    else:
+        serve_forked(SERVER_HOST, SERVER_PORT, SERVER_WORKERS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import re
+from array import array
+
+# Operators in ProvSQL's formula semiring output (sr_formula)
+PLUS = "⊕"
+TIMES = "⊗"
+MONUS = "⊖"
+DELTA = "δ"
+ZERO = "𝟘"
+ONE = "𝟙"
+
+# The same symbols after UTF-8 output was read back with the wrong code page
+# (cp1252, cp437, or both in turn)
+MOJIBAKE = {
+    "├ó┼áΓÇó": PLUS,
+    "├ó┼áΓÇö": TIMES,
+    "├ó┼áΓÇô": MONUS,
+    "âŠ•": PLUS,
+    "âŠ—": TIMES,
+    "âŠ–": MONUS,
+    "Γèò": PLUS,
+    "Γèù": TIMES,
+    "Γèû": MONUS,
+}
+
+# Node kinds
+LEAF, OP_PLUS, OP_TIMES, OP_MONUS, OP_DELTA, OP_ZERO, OP_ONE = range(7)
+SYMBOLS = {OP_PLUS: PLUS, OP_TIMES: TIMES, OP_MONUS: MONUS, OP_DELTA: DELTA}
+BINARY = {PLUS: OP_PLUS, TIMES: OP_TIMES, MONUS: OP_MONUS}
+# Binding strength, ⊗ binds tighter than ⊖, which binds tighter than ⊕
+PRECEDENCE = {OP_PLUS: 0, OP_MONUS: 1, OP_TIMES: 2}
+
+TOKEN_RE = re.compile(f"({PLUS}|{TIMES}|{MONUS}|{DELTA}|{ZERO}|{ONE}|\\(|\\))")
+
+
+def normalize(formula: str) -> str:
+    for bad, good in MOJIBAKE.items():
+        if bad in formula:
+            formula = formula.replace(bad, good)
+    return formula
+
+
+def tokenize(formula: str):
+    # Operators and parentheses as themselves, anything in between is a leaf
+    # (the value the provenance mapping gives an input tuple)
+    for part in TOKEN_RE.split(normalize(formula)):
+        part = part.strip()
+        if part:
+            yield part
+
+
+class FormulaDAG:
+    # Formulas of a whole result in one DAG. Identical subexpressions are
+    # stored once (hash-consing), so memory follows the number of distinct
+    # subterms rather than the total length of the formulas. Nodes are ints
+    # indexing parallel arrays: kind, children and leaf label.
+
+    __slots__ = ("kinds", "args", "labels", "_index")
+
+    def __init__(self):
+        self.kinds = array("B")
+        self.args = []
+        self.labels = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def _node(self, kind, args=(), label=None):
+        key = (kind, label) if kind == LEAF else (kind, args)
+        node = self._index.get(key)
+        if node is None:
+            node = self._index[key] = len(self.kinds)
+            self.kinds.append(kind)
+            self.args.append(args)
+            self.labels.append(label)
+        return node
+
+    def leaf(self, label: str):
+        return self._node(LEAF, label=label)
+
+    def apply(self, kind, args):
+        # ⊕ and ⊗ are associative, nested ones are flattened
+        if kind in (OP_PLUS, OP_TIMES):
+            flat = []
+            for a in args:
+                if self.kinds[a] == kind:
+                    flat.extend(self.args[a])
+                else:
+                    flat.append(a)
+            args = flat
+            if len(args) == 1:
+                return args[0]
+        return self._node(kind, tuple(args))
+
+    def parse(self, formula: str):
+        # Root node of one sr_formula value. Never raises: unbalanced
+        # parentheses are closed or skipped, missing operators read as ⊗.
+        frames = [_Frame()]
+        for token in tokenize(formula or ""):
+            frame = frames[-1]
+            if token == "(":
+                frames.append(_Frame())
+            elif token == ")":
+                if len(frames) > 1:
+                    frames.pop()
+                    frames[-1].operand(self, frame.reduce(self))
+            elif token in BINARY:
+                if frame.operands and len(frame.ops) < len(frame.operands):
+                    frame.ops.append(BINARY[token])
+            elif token == DELTA:
+                frame.deltas += 1
+            elif token == ZERO:
+                frame.operand(self, self._node(OP_ZERO))
+            elif token == ONE:
+                frame.operand(self, self._node(OP_ONE))
+            else:
+                frame.operand(self, self.leaf(token))
+        while len(frames) > 1:
+            inner = frames.pop()
+            frames[-1].operand(self, inner.reduce(self))
+        return frames[0].reduce(self)
+
+    def kind(self, node):
+        return self.kinds[node]
+
+    def label(self, node):
+        return self.labels[node]
+
+    def symbol(self, node):
+        return SYMBOLS.get(self.kinds[node], self.labels[node])
+
+    def leaves(self, node):
+        # Distinct input tuples under a node, in order of first appearance.
+        # Each shared subterm is walked once.
+        seen = set()
+        out = []
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            if self.kinds[n] == LEAF:
+                out.append(self.labels[n])
+            else:
+                stack.extend(reversed(self.args[n]))
+        return out
+
+    def to_string(self, node, limit=None):
+        # Formula text back from the DAG, cut after `limit` characters
+        parts = []
+        length = 0
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if isinstance(n, str):
+                text = n
+            else:
+                kind = self.kinds[n]
+                if kind == LEAF:
+                    text = self.labels[n]
+                elif kind == OP_ZERO:
+                    text = ZERO
+                elif kind == OP_ONE:
+                    text = ONE
+                elif kind == OP_DELTA:
+                    stack.extend([")", self.args[n][0]])
+                    text = DELTA + "("
+                else:
+                    sep = f" {SYMBOLS[kind]} "
+                    items = [")"]
+                    for i, a in enumerate(reversed(self.args[n])):
+                        if i:
+                            items.append(sep)
+                        items.append(a)
+                    stack.extend(items)
+                    text = "("
+            parts.append(text)
+            length += len(text)
+            if limit is not None and length > limit:
+                return "".join(parts)[:limit] + "…"
+        return "".join(parts)
+
+    def stats(self):
+        kinds = self.kinds
+        return {
+            "nodes": len(kinds),
+            "leaves": kinds.count(LEAF),
+            "edges": sum(len(a) for a in self.args),
+        }
+
+    def to_dict(self, roots=None):
+        # JSON-friendly export: nodes by index, plus named roots
+        nodes = []
+        for n, kind in enumerate(self.kinds):
+            if kind == LEAF:
+                nodes.append({"leaf": self.labels[n]})
+            elif kind in SYMBOLS:
+                nodes.append({"op": SYMBOLS[kind], "args": list(self.args[n])})
+            else:
+                nodes.append({"const": ZERO if kind == OP_ZERO else ONE})
+        result = {"nodes": nodes}
+        if roots is not None:
+            result["roots"] = roots
+        return result
+
+
+class _Frame:
+    # Operands and operators inside one pair of parentheses
+
+    __slots__ = ("operands", "ops", "deltas")
+
+    def __init__(self):
+        self.operands = []
+        self.ops = []
+        self.deltas = 0
+
+    def operand(self, dag, node):
+        while self.deltas:
+            node = dag.apply(OP_DELTA, (node,))
+            self.deltas -= 1
+        if len(self.ops) < len(self.operands):
+            # Two operands in a row, read as a product
+            self.ops.append(OP_TIMES)
+        self.operands.append(node)
+
+    def reduce(self, dag):
+        operands = self.operands
+        if not operands:
+            return dag._node(OP_ZERO)
+        ops = self.ops[: len(operands) - 1]
+        # Operator precedence, lowest level first: split on ⊕, then ⊖, then ⊗
+        return _reduce(dag, operands, ops, 0)
+
+
+def _reduce(dag, operands, ops, level):
+    if not ops:
+        return operands[0]
+    kind = next(k for k, p in PRECEDENCE.items() if p == level)
+    groups = [[operands[0]]]
+    group_ops = [[]]
+    for op, node in zip(ops, operands[1:]):
+        if op == kind:
+            groups.append([node])
+            group_ops.append([])
+        else:
+            group_ops[-1].append(op)
+            groups[-1].append(node)
+    terms = [_reduce(dag, g, o, level + 1) for g, o in zip(groups, group_ops)]
+    if len(terms) == 1:
+        return terms[0]
+    if kind == OP_MONUS:
+        # a ⊖ b ⊖ c is (a ⊖ b) ⊖ c
+        node = terms[0]
+        for t in terms[1:]:
+            node = dag.apply(OP_MONUS, (node, t))
+        return node
+    return dag.apply(kind, terms)
@@ -0,0 +1,224 @@
+import csv
+import re
+from itertools import chain, islice
+
+
+SEPARATOR_RE = re.compile(r"^\s*-+\s*(\+-+\s*)*$")
+ERROR_RE = re.compile(r"^(ERROR|FATAL|PANIC|psql:|WARNING|NOTICE)\b")
+# Numbers as PostgreSQL prints them. psql --csv carries no column types,
+# so anything else (leading zeros as in ids and zip codes, "1e3", more
+# digits than a float holds) is text and keeps its column as text.
+INT_RE = re.compile(r"^-?(0|[1-9]\d{0,17})$")
+FLOAT_RE = re.compile(r"^-?(0|[1-9]\d*)(\.\d+)?([eE][-+]\d+)?$")
+FLOAT_DIGITS = 15
+FOOTER_RE = re.compile(r"^\s*\(\d+ rows?\)\s*$")
+
+# Rows shown on the page, the rest go to the result store
+FIRST_PAGE_ROWS = 200
+
+
+def iter_process_lines(process):
+    # stdout lines of a running process, stderr if stdout was empty.
+    # The process is killed if the reader stops early.
+    try:
+        empty = True
+        for line in process.stdout:
+            empty = False
+            yield line
+        if empty and process.stderr is not None:
+            yield from process.stderr
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+class StreamingTable:
+    # Incremental version of parse_psql_ascii_table. Reads lines up to the
+    # header separator, then rows() parses the remaining lines one by one.
+    # When no table is found the whole output ends up in `text` and can be
+    # handed to the buffered parsers.
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self.columns = []
+        self.found = False
+        self._trim = False
+        self._multi = True
+
+        buffered = []
+        header = None
+        for line in self._lines:
+            if line.strip() and SEPARATOR_RE.match(line.rstrip()):
+                if header is not None:
+                    self.found = True
+                    break
+            buffered.append(line)
+            if line.strip():
+                header = line.rstrip()
+        self.text = "".join(buffered)
+
+        if self.found:
+            self.columns = [c.strip() for c in header.split("|")]
+            self._multi = "|" in header
+            if len(self.columns) > 1 and self.columns[-1] == "":
+                # psql border style leaves an empty trailing column
+                self.columns = self.columns[:-1]
+                self._trim = True
+
+    def rows(self):
+        try:
+            for line in self._lines:
+                line = line.rstrip()
+                if not line.strip() or SEPARATOR_RE.match(line):
+                    continue
+                if self._multi and "|" not in line:
+                    continue
+                if not self._multi and FOOTER_RE.match(line):
+                    continue
+                row = [cell.strip() for cell in line.split("|")]
+                if self._trim and row[-1] == "":
+                    row = row[:-1]
+                if any(cell != "" for cell in row):
+                    yield row
+        finally:
+            self.close()
+
+    def close(self):
+        close = getattr(self._lines, "close", None)
+        if close is not None:
+            close()
+
+
+class CsvTable:
+    # Same interface as StreamingTable for psql --csv output: proper quoting,
+    # so cells containing "|", commas or newlines are not mis-split. Output
+    # without data rows (command tags, errors) ends up in `text`.
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self.columns = []
+        self.found = False
+        self._first = None
+
+        header = next(self._lines, "")
+        self.text = header
+        if not header.strip() or ERROR_RE.match(header):
+            # Errors and notices span several lines, keep all of them
+            self.text += "".join(self._lines)
+            return
+        reader = csv.reader(self._lines)
+        self._reader = reader
+        self._first = next(reader, None)
+        if self._first is None:
+            return
+        self.found = True
+        self.columns = next(csv.reader([header]))
+
+    def rows(self):
+        try:
+            if self._first is None:
+                return
+            yield self._first
+            yield from self._reader
+        finally:
+            self.close()
+
+    def close(self):
+        close = getattr(self._lines, "close", None)
+        if close is not None:
+            close()
+
+
+class TypedCsvTable(CsvTable):
+    # CsvTable whose rows are typed, see decode_columns
+
+    def rows(self):
+        return decode_columns(super().rows())
+
+
+def is_number(value, kind):
+    if kind is int:
+        return bool(INT_RE.match(value))
+    if not FLOAT_RE.match(value):
+        return False
+    mantissa = re.split("[eE]", value)[0]
+    return len(mantissa.lstrip("-0.").replace(".", "")) <= FLOAT_DIGITS
+
+
+def decode_columns(rows, sample=FIRST_PAGE_ROWS):
+    # Text rows → typed rows. A column becomes int or float when every
+    # value in the first `sample` rows is one (empty is NULL, see
+    # is_number); later values that are not are kept as text.
+    try:
+        yield from _decode(iter(rows), sample)
+    finally:
+        close = getattr(rows, "close", None)
+        if close is not None:
+            close()
+
+
+def _decode(rows, sample):
+    head = list(islice(rows, sample))
+    if not head:
+        return
+    width = max(len(r) for r in head)
+    kinds = []
+    for i in range(width):
+        values = [r[i] for r in head if i < len(r) and r[i] != ""]
+        kind = None
+        if values and all(is_number(v, int) for v in values):
+            kind = int
+        elif values and all(is_number(v, float) for v in values):
+            kind = float
+        kinds.append(kind)
+    typed = [(i, k) for i, k in enumerate(kinds) if k is not None]
+    if not typed:
+        yield from head
+        yield from rows
+        return
+    for row in chain(head, rows):
+        for i, kind in typed:
+            if i < len(row):
+                if row[i] == "":
+                    row[i] = None
+                elif is_number(row[i], kind):
+                    row[i] = kind(row[i])
+        yield row
+
+
+def extract_digraph(lines, marker="GRAPHVIZ: AFTER OPTIMIZATIONS"):
+    # Single pass over gprom -show_graphviz output: returns (dot, text) where
+    # dot is the first digraph after `marker` (None if there is none) and
+    # text is the output read before it. Stops reading once the graph closes.
+    seen = []
+    graph = []
+    found = False
+    depth = 0
+    for line in lines:
+        if graph:
+            graph.append(line)
+            depth += line.count("{") - line.count("}")
+            if depth <= 0:
+                break
+        elif found and "digraph" in line and "{" in line:
+            graph.append(line[line.index("digraph") :])
+            depth = line.count("{") - line.count("}")
+            if depth <= 0:
+                break
+        else:
+            seen.append(line)
+            if marker in line:
+                found = True
+    close = getattr(lines, "close", None)
+    if close is not None:
+        close()
+    return ("".join(graph) if graph else None), "".join(seen)
+
+
+def first_page(rows, n=FIRST_PAGE_ROWS):
+    # Returns (page, rest). rest is None when the rows fit on the page.
+    page = list(islice(rows, n + 1))
+    if len(page) <= n:
+        return page, None
+    return page[:n], chain(page[n:], rows)
@@ -0,0 +1,93 @@
+import os
+import re
+from array import array
+from collections import Counter
+
+# NumPy is imported on first use, see numpy_module()
+np = None
+_numpy_missing = False
+
+
+# Most common values returned by a summary, whatever the result size
+SUMMARY_LIMIT = int(os.environ.get("SUMMARY_LIMIT", "100"))
+
+IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def quote_ident(name: str) -> str:
+    # Plain identifiers stay unquoted so each engine applies its own case
+    # folding (psql prints lower case, gprom upper case)
+    if IDENT_RE.match(name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def summary_query(full_query: str, column: str, limit=SUMMARY_LIMIT) -> str:
+    # Occurrences per value of `column`, counted by the engine, so only
+    # `limit` rows come back however large the provenance result is
+    col = quote_ident(column)
+    inner = full_query.strip().rstrip(";")
+    return (
+        f"SELECT {col} AS value, COUNT(*) AS occurrences "
+        f"FROM ({inner}) summary_t GROUP BY {col} "
+        f"ORDER BY occurrences DESC LIMIT {int(limit)};"
+    )
+
+
+def column_index(columns, column) -> int:
+    # `column` is a column name (case-insensitive) or its position
+    if column is None or column == "":
+        return 0
+    names = [str(c).lower() for c in columns]
+    if str(column).lower() in names:
+        return names.index(str(column).lower())
+    try:
+        index = int(column)
+    except (TypeError, ValueError):
+        raise KeyError(column)
+    if not 0 <= index < len(columns):
+        raise KeyError(column)
+    return index
+
+
+def numpy_module():
+    # Optional, counting falls back to Counter without it
+    global np, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+            return None
+        np = numpy
+    return np
+
+
+def count_values(values, limit=SUMMARY_LIMIT):
+    # (labels, counts) of the most common values of one column. Numeric
+    # columns are counted with NumPy when it is installed.
+    if (
+        len(values)
+        and (isinstance(values, array) or all(type(v) in (int, float) for v in values))
+        and numpy_module() is not None
+    ):
+        uniq, counts = np.unique(np.asarray(values), return_counts=True)
+        order = np.argsort(-counts, kind="stable")[:limit]
+        return uniq[order].tolist(), counts[order].tolist()
+    common = Counter(values).most_common(limit)
+    return [v for v, _ in common], [c for _, c in common]
+
+
+def summary_rows(rows):
+    # Chart data from the (value, occurrences) rows of a summary_query
+    labels = []
+    counts = []
+    for row in rows:
+        if len(row) < 2:
+            continue
+        try:
+            counts.append(int(row[1]))
+        except (TypeError, ValueError):
+            continue
+        labels.append(row[0])
+    return labels, counts